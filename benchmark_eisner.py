@@ -0,0 +1,86 @@
+from __future__ import print_function
+from builtins import range
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+import eisner_for_dmv
+import eisner_for_dmv_legacy
+
+
+# Compare the span-by-span chart algorithms with the width-wise numpy ones, and with the torch ones when --torch is
+# given, on random DMV scores
+
+def random_scores(batch_size, sentence_length, dvalency, cvalency):
+    batch_scores = np.log(np.random.rand(batch_size, sentence_length, sentence_length, 1, 1, cvalency))
+    # Root can not be taken as child
+    batch_scores[:, :, 0] = -np.inf
+    batch_decision_score = np.log(np.random.rand(batch_size, sentence_length, 1, 2, dvalency, 2))
+    batch_decision_score[:, 0] = 0
+    return batch_scores, batch_decision_score
+
+
+def time_engine(engine, batch_scores, batch_decision_score, dvalency, cvalency, repeat):
+    timing = {'inside': 0.0, 'outside': 0.0, 'parse': 0.0}
+    for _ in range(repeat):
+        start = time.time()
+        inside_complete_table, inside_incomplete_table, _ = engine.batch_inside(batch_scores, batch_decision_score,
+                                                                                dvalency, cvalency)
+        timing['inside'] += time.time() - start
+        start = time.time()
+        engine.batch_outside(inside_complete_table, inside_incomplete_table, batch_scores, batch_decision_score,
+                             dvalency, cvalency)
+        timing['outside'] += time.time() - start
+        start = time.time()
+        engine.batch_parse(batch_scores, batch_decision_score, dvalency, cvalency)
+        timing['parse'] += time.time() - start
+    return {k: v / repeat for k, v in timing.items()}
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--batch", type="int", dest="batchsize", default=100)
+    parser.add_option("--lengths", type="string", dest="lengths", default="5,10,15,20,25,30,35,40",
+                      help="comma separated sentence lengths, root included")
+    parser.add_option("--dvalency", type="int", dest="d_valency", default=2)
+    parser.add_option("--cvalency", type="int", dest="c_valency", default=1)
+    parser.add_option("--repeat", type="int", dest="repeat", default=3)
+    parser.add_option("--seed", type="int", dest="seed", default=0)
+    parser.add_option("--torch", action="store_true", dest="torch", default=False,
+                      help="also time the torch backend")
+    parser.add_option("--num_threads", type="int", dest="num_threads", default=0,
+                      help="with --torch, torch intra-op threads, 0 keeps the torch default")
+
+    (options, args) = parser.parse_args()
+
+    np.random.seed(options.seed)
+    np.seterr(divide='ignore', invalid='ignore')
+    if options.torch:
+        import torch
+        import torch_eisner_for_dmv
+        if options.num_threads > 0:
+            torch.set_num_threads(options.num_threads)
+        print('%6s %8s %10s %10s %10s %8s %8s' % ('length', 'pass', 'old (s)', 'new (s)', 'torch (s)', 'new', 'torch'))
+    else:
+        print('%6s %8s %10s %10s %8s' % ('length', 'pass', 'old (s)', 'new (s)', 'new'))
+    for sentence_length in [int(l) for l in options.lengths.split(',')]:
+        batch_scores, batch_decision_score = random_scores(options.batchsize, sentence_length, options.d_valency,
+                                                           options.c_valency)
+        old_timing = time_engine(eisner_for_dmv_legacy, batch_scores, batch_decision_score, options.d_valency,
+                                 options.c_valency, options.repeat)
+        new_timing = time_engine(eisner_for_dmv, batch_scores, batch_decision_score, options.d_valency,
+                                 options.c_valency, options.repeat)
+        if options.torch:
+            torch_timing = time_engine(torch_eisner_for_dmv, torch.from_numpy(batch_scores),
+                                       torch.from_numpy(batch_decision_score), options.d_valency, options.c_valency,
+                                       options.repeat)
+        for name in ['inside', 'outside', 'parse']:
+            if options.torch:
+                print('%6d %8s %10.4f %10.4f %10.4f %7.1fx %7.1fx' % (sentence_length, name, old_timing[name],
+                                                                      new_timing[name], torch_timing[name],
+                                                                      old_timing[name] / new_timing[name],
+                                                                      old_timing[name] / torch_timing[name]))
+            else:
+                print('%6d %8s %10.4f %10.4f %7.1fx' % (sentence_length, name, old_timing[name], new_timing[name],
+                                                        old_timing[name] / new_timing[name]))
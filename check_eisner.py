@@ -0,0 +1,112 @@
+from __future__ import print_function
+from builtins import range
+from optparse import OptionParser
+
+import numpy as np
+
+import eisner_for_dmv
+import eisner_for_dmv_legacy
+from benchmark_eisner import random_scores
+
+
+# Check the width-wise chart algorithms of eisner_for_dmv against the span-by-span ones of eisner_for_dmv_legacy on
+# random DMV scores: inside and outside tables must agree to rounding, parses of sentences that have a tree must be
+# identical. With --torch, the torch backend is checked against eisner_for_dmv the same way.
+
+def compare_tables(name, new_table, reference_table, rtol):
+    # legacy charts are numbered like the new ones but allocated larger, the extra rows are never used
+    reference_table = reference_table[:, :new_table.shape[1]]
+    impossible = np.isneginf(reference_table)
+    if not np.array_equal(np.isneginf(new_table), impossible):
+        return '%s: -inf entries differ' % name
+    if not np.allclose(new_table[~impossible], reference_table[~impossible], rtol=rtol, atol=0):
+        return '%s: max difference %g' % (name, np.max(np.abs(new_table[~impossible] -
+                                                              reference_table[~impossible])))
+    return None
+
+
+def run_engine(engine, batch_scores, batch_decision_score, dvalency, cvalency):
+    # inside tables and partition, outside tables and parse of one chart engine
+    inside = engine.batch_inside(batch_scores, batch_decision_score, dvalency, cvalency)
+    outside = engine.batch_outside(inside[0], inside[1], batch_scores, batch_decision_score, dvalency, cvalency)
+    parse = engine.batch_parse(batch_scores, batch_decision_score, dvalency, cvalency)
+    return list(inside), list(outside), parse
+
+
+def run_torch_engine(batch_scores, batch_decision_score, dvalency, cvalency):
+    # torch_eisner_for_dmv on the same scores, its tables read back as numpy with the finite stand-in for log(0) as
+    # -inf
+    inside, outside, parse = run_engine(torch_eisner_for_dmv, torch.from_numpy(batch_scores),
+                                        torch.from_numpy(batch_decision_score), dvalency, cvalency)
+    inside, outside = [[np.where(t.numpy() <= torch_eisner_for_dmv.NEG_INF, -np.inf, t.numpy()) for t in tables]
+                       for tables in (inside, outside)]
+    return inside, outside, parse
+
+
+def compare_engines(new_result, reference_result, rtol):
+    new_inside, new_outside, new_parse = new_result
+    reference_inside, reference_outside, reference_parse = reference_result
+    batch_size = len(new_inside[2])
+    errors = []
+    for name, new_table, reference_table in zip(['inside complete', 'inside incomplete'], new_inside,
+                                                reference_inside):
+        errors.append(compare_tables(name, new_table, reference_table, rtol))
+    errors.append(compare_tables('partition', new_inside[2][:, np.newaxis], reference_inside[2][:, np.newaxis],
+                                 rtol))
+    for name, new_table, reference_table in zip(['outside complete', 'outside incomplete'], new_outside,
+                                                reference_outside):
+        errors.append(compare_tables(name, new_table, reference_table, rtol))
+    # sentences without any tree have no parse to agree on
+    parsed = np.isfinite(reference_inside[2])
+    for name, new_parse_result, reference_parse_result in zip(['heads', 'tags', 'head valences', 'valences'],
+                                                              new_parse, reference_parse):
+        differ = np.any((new_parse_result != reference_parse_result).reshape(batch_size, -1), axis=1) & parsed
+        if np.any(differ):
+            errors.append('parse %s differ for %d sentences' % (name, np.count_nonzero(differ)))
+    return [e for e in errors if e is not None]
+
+
+def check_length(batch_size, sentence_length, dvalency, cvalency, rtol, check_torch):
+    batch_scores, batch_decision_score = random_scores(batch_size, sentence_length, dvalency, cvalency)
+    # some arcs can not be taken at all, as with --function_mask
+    batch_scores[np.random.rand(batch_size, sentence_length, sentence_length) < 0.2] = -np.inf
+    numpy_result = run_engine(eisner_for_dmv, batch_scores, batch_decision_score, dvalency, cvalency)
+    legacy_result = run_engine(eisner_for_dmv_legacy, batch_scores, batch_decision_score, dvalency, cvalency)
+    errors = {'numpy': compare_engines(numpy_result, legacy_result, rtol)}
+    if check_torch:
+        torch_result = run_torch_engine(batch_scores, batch_decision_score, dvalency, cvalency)
+        errors['torch'] = compare_engines(torch_result, numpy_result, rtol)
+    return errors
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--batch", type="int", dest="batchsize", default=20)
+    parser.add_option("--lengths", type="string", dest="lengths", default="2,3,4,5,8,12",
+                      help="comma separated sentence lengths, root included")
+    parser.add_option("--dvalency", type="int", dest="d_valency", default=2)
+    parser.add_option("--cvalency", type="string", dest="c_valency", default="1,2",
+                      help="comma separated child valences, each 1 or dvalency")
+    parser.add_option("--rtol", type="float", dest="rtol", default=1e-10)
+    parser.add_option("--seed", type="int", dest="seed", default=0)
+    parser.add_option("--torch", action="store_true", dest="torch", default=False,
+                      help="also check the torch backend against the numpy one")
+
+    (options, args) = parser.parse_args()
+
+    np.random.seed(options.seed)
+    np.seterr(divide='ignore', invalid='ignore')
+    if options.torch:
+        import torch
+        import torch_eisner_for_dmv
+    failed = False
+    for c_valency in [int(c) for c in options.c_valency.split(',')]:
+        for sentence_length in [int(l) for l in options.lengths.split(',')]:
+            errors = check_length(options.batchsize, sentence_length, options.d_valency, c_valency, options.rtol,
+                                  options.torch)
+            for name in sorted(errors.keys()):
+                print('%s, cvalency %d, length %d: %s' % (name, c_valency, sentence_length,
+                                                           'ok' if not errors[name] else '; '.join(errors[name])))
+                failed = failed or len(errors[name]) > 0
+    if failed:
+        raise SystemExit(1)
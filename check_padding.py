@@ -0,0 +1,129 @@
+from __future__ import print_function
+from builtins import range
+import math
+import os
+from optparse import OptionParser, Values
+
+import numpy as np
+
+import utils
+from ml_dmv_model import ml_dmv_model as MLDMV
+
+
+# Check that padded batches (--bucket_batches) give the E-step counts and Viterbi parses of exact-length batches on
+# treebank sentences. Padded charts add the same scores in another order, so counts and likelihoods must agree to
+# rounding, and a parse may only differ where both trees score the same up to rounding.
+
+def model_options(options):
+    return Values({'shared_param': False, 'memmap_dir': None, 'count_smoothing': 1e-8, 'param_smoothing': 1e-8,
+                   'em_type': 'em', 'estep_engine': 'inside_outside', 'eisner_backend': options.eisner_backend,
+                   'function_mask': options.function_mask, 'use_neural': False, 'unified_network': False,
+                   'c_valency': options.c_valency, 'd_valency': options.d_valency, 'sentence_predict': False,
+                   'concat_all': False})
+
+
+def tree_score(batch_score, batch_decision_score, heads, dvalency, cvalency):
+    # Score of the tree given by heads for a single unpadded sentence. Children of a head take valences in order of
+    # distance, and every head stops on both sides after its last child.
+    sentence_length = len(heads)
+    terms = []
+    for h in range(sentence_length):
+        for dir in range(2):
+            if dir == 0:
+                children = [m for m in range(h - 1, -1, -1) if heads[m] == h]
+            else:
+                children = [m for m in range(h + 1, sentence_length) if heads[m] == h]
+            for i, m in enumerate(children):
+                valence = min(i, dvalency - 1)
+                terms.append(batch_decision_score[0, h, dir, valence, 1])
+                terms.append(batch_score[0, h, m, min(valence, cvalency - 1)])
+            terms.append(batch_decision_score[0, h, dir, min(len(children), dvalency - 1), 0])
+    return math.fsum(terms)
+
+
+def parse(dmv_model, batches, language_map, languages):
+    parse_results = {}
+    for one_batch in batches:
+        batch_pos, batch_len = utils.pad_batch_pos([s[0] for s in one_batch])
+        batch_sen = np.array([s[2][0] for s in one_batch])
+        batch_score, batch_decision_score = dmv_model.evaluate_batch_score(batch_pos, batch_sen, language_map,
+                                                                           languages, None)
+        for sentence_id, result in zip(batch_sen, dmv_model.parse_batch(batch_score, batch_decision_score,
+                                                                        batch_pos, batch_len)):
+            parse_results[sentence_id] = result[0]
+    return parse_results
+
+
+def expected_counts(dmv_model, batches, pos_num, language_num):
+    trans_counter = np.zeros((pos_num, pos_num, 2, dmv_model.cvalency, language_num))
+    decision_counter = np.zeros((pos_num, 2, dmv_model.dvalency, 2, language_num))
+    likelihood = 0.0
+    for one_batch in batches:
+        batch_likelihood, _ = dmv_model.em_e([s[0] for s in one_batch], [s[1] for s in one_batch],
+                                             [s[2][0] for s in one_batch], trans_counter, decision_counter, 'em')
+        likelihood += batch_likelihood
+    return trans_counter, decision_counter, likelihood
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--train", dest="train", help="train file", metavar="FILE", default="data/ud_file")
+    parser.add_option("--corpus_cache", type="string", dest="corpus_cache", default=None)
+    parser.add_option("--languages", type="string", dest="languages", default="en,nl",
+                      help="comma separated languages whose training sentences are checked")
+    parser.add_option("--sentences", type="int", dest="sentences", default=800)
+    parser.add_option("--max_length", type="int", dest="max_length", default=12,
+                      help="longest sentence checked, root excluded")
+    parser.add_option("--batch", type="int", dest="batchsize", default=100)
+    parser.add_option("--dvalency", type="int", dest="d_valency", default=2)
+    parser.add_option("--cvalency", type="int", dest="c_valency", default=2)
+    parser.add_option("--function_mask", action="store_true", default=False)
+    parser.add_option("--eisner_backend", type="choice", dest="eisner_backend", choices=['numpy', 'torch'],
+                      default='numpy')
+    parser.add_option("--rtol", type="float", dest="rtol", default=1e-9)
+
+    (options, args) = parser.parse_args()
+
+    np.seterr(divide='ignore')
+    file_set = utils.get_file_set(os.listdir(options.train), set(options.languages.split(',')), True)
+    pos, sentences, languages, language_map = utils.read_multiple_data(options.train, file_set, False,
+                                                                       options.corpus_cache)
+    data_list, _, sentence_map = utils.construct_ml_pos_data(sentences, pos, languages, language_map)
+    dmv_model = MLDMV(pos, sentence_map, languages, language_map, len(data_list), model_options(options))
+    dmv_model.init_param(sentences)
+    dmv_model.eval()
+    checked = [s for s in data_list if len(s[0]) <= options.max_length + 1][:options.sentences]
+    exact_batches = utils.construct_batch_data(list(checked), options.batchsize)
+    padded_batches = utils.construct_bucket_batch_data(checked, options.batchsize)
+    failed = False
+
+    exact_counts = expected_counts(dmv_model, exact_batches, len(pos), len(languages))
+    padded_counts = expected_counts(dmv_model, padded_batches, len(pos), len(languages))
+    for name, exact, padded in zip(['arc counts', 'decision counts', 'likelihood'], exact_counts, padded_counts):
+        close = np.allclose(exact, padded, rtol=options.rtol, atol=0)
+        print('%s: %s' % (name, 'ok' if close else 'max difference %g' % np.max(np.abs(exact - padded))))
+        failed = failed or not close
+
+    exact_parses = parse(dmv_model, exact_batches, language_map, languages)
+    padded_parses = parse(dmv_model, padded_batches, language_map, languages)
+    ties = 0
+    for sentence_id in sorted(exact_parses.keys()):
+        exact_heads, padded_heads = exact_parses[sentence_id], padded_parses[sentence_id]
+        if np.array_equal(exact_heads, padded_heads):
+            continue
+        sentence_pos = np.array([sentence_map[sentence_id]])
+        batch_score, batch_decision_score = dmv_model.evaluate_batch_score(sentence_pos, [sentence_id], language_map,
+                                                                           languages, None)
+        if options.function_mask:
+            batch_score = dmv_model.function_to_mask(batch_score, sentence_pos)
+        exact_score, padded_score = [tree_score(batch_score, batch_decision_score, heads, dmv_model.dvalency,
+                                                dmv_model.cvalency) for heads in (exact_heads, padded_heads)]
+        tie = math.isclose(exact_score, padded_score, rel_tol=options.rtol)
+        print('sentence %d: exact %s scores %r, padded %s scores %r%s' % (
+            sentence_id, exact_heads.astype(int).tolist(), exact_score, padded_heads.astype(int).tolist(),
+            padded_score, '' if tie else ', not a tie'))
+        ties += tie
+        failed = failed or not tie
+    print('parses: %d sentences, %d differ by ties' % (len(exact_parses), ties))
+    if failed:
+        raise SystemExit(1)
@@ -2,334 +2,285 @@ from builtins import range
 import numpy as np
 
 import utils
-from scipy.special import logsumexp
-#from scipy.misc import logsumexp
 
 
 def batch_parse(batch_scores, batch_decision_score, valency_num, cvalency_num):
     batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    # span index table, to avoid redundant iterations
+    index = utils.get_span_index(sentence_length)
+    width_index = index.widths
+    chart_size = index.chart_size
     # CYK table
-    complete_table = np.zeros((batch_size, sentence_length * sentence_length * 2, tag_num, valency_num))
-    incomplete_table = np.zeros((batch_size, sentence_length * sentence_length * 2, tag_num, tag_num, valency_num))
+    complete_table = np.zeros((batch_size, chart_size, tag_num, valency_num))
+    incomplete_table = np.zeros((batch_size, chart_size, tag_num, tag_num, valency_num))
     complete_table.fill(-np.inf)
     incomplete_table.fill(-np.inf)
     # backtrack table
-    complete_backtrack = -np.ones((batch_size, sentence_length * sentence_length * 2, tag_num, valency_num), dtype=int)
-    incomplete_backtrack = -np.ones((batch_size, sentence_length * sentence_length * 2, tag_num, tag_num, valency_num),
-                                    dtype=int)
-    # span index table, to avoid redundant iterations
-    span_2_id, id_2_span, ijss, ikcs, ikis, kjcs, kjis, basic_span = utils.constituent_index(sentence_length, False)
+    complete_backtrack = -np.ones((batch_size, chart_size, tag_num, valency_num), dtype=int)
+    incomplete_backtrack = -np.ones((batch_size, chart_size, tag_num, tag_num, valency_num), dtype=int)
     # initial basic complete spans
-    for ii in basic_span:
-        (i, i, dir) = id_2_span[ii]
-        complete_table[:, ii, :, :] = batch_decision_score[:, i, :, dir, :, 0]
-    for ij in ijss:
-        (l, r, dir) = id_2_span[ij]
-        num_ki = len(ikis[ij])
-        ik_ci = complete_table[:, ikis[ij], :, :].reshape(batch_size, num_ki, tag_num, 1, valency_num)
-        kj_ci = complete_table[:, kjis[ij], :, :].reshape(batch_size, num_ki, 1, tag_num, valency_num)
+    complete_table[:, index.basic_span] = batch_decision_score[:, :, :, :, :, 0].transpose(0, 1, 3, 2, 4)[
+                                          :, index.basic_pos, index.basic_dir]
+    for w in range(1, sentence_length):
         # construct incomplete spans
-        if dir == 0:
-            span_i = ik_ci[:, :, :, :, 0].reshape(batch_size, num_ki, tag_num, 1, 1) \
-                     + kj_ci[:, :, :, :, 1].reshape(batch_size, num_ki, 1, tag_num, 1) + \
-                     batch_scores[:, r, l, :, :, :].swapaxes(1, 2).reshape(batch_size, 1, tag_num, tag_num,
-                                                                           cvalency_num) \
-                     + batch_decision_score[:, r, :, dir, :, 1].reshape(batch_size, 1, 1, tag_num, valency_num)
-        else:
-            span_i = ik_ci[:, :, :, :, 1].reshape(batch_size, num_ki, tag_num, 1, 1) \
-                     + kj_ci[:, :, :, :, 0].reshape(batch_size, num_ki, 1, tag_num, 1) + \
-                     batch_scores[:, l, r, :, :, :].reshape(batch_size, 1, tag_num, tag_num, cvalency_num) \
-                     + batch_decision_score[:, l, :, dir, :, 1].reshape(batch_size, 1, tag_num, 1, valency_num)
-        max = np.max(span_i, axis=1)
-
-        incomplete_table[:, ij, :, :, :] = np.max(span_i, axis=1)
-        max_idx = np.argmax(span_i, axis=1)
-        incomplete_backtrack[:, ij, :, :, :] = max_idx
+        for dir in range(2):
+            ids = width_index[w][dir][0]
+            span_i = _incomplete_span_score(complete_table, batch_scores, batch_decision_score, w, dir,
+                                            width_index[w][dir], valency_num, cvalency_num)
+            incomplete_table[:, ids], incomplete_backtrack[:, ids] = _max_argmax(span_i, 2)
         # construct complete spans
-        num_kc = len(ikcs[ij])
-        if dir == 0:
-            ik_cc = complete_table[:, ikcs[ij], :, :].reshape(batch_size, num_kc, tag_num, 1, valency_num)
-            kj_ic = incomplete_table[:, kjcs[ij], :, :, :].reshape(batch_size, num_kc, tag_num, tag_num, valency_num)
-            span_c = ik_cc[:, :, :, :, 0].reshape(batch_size, num_kc, tag_num, 1, 1) + kj_ic
-            span_c = span_c.reshape(batch_size, num_kc * tag_num, tag_num, valency_num)
-        else:
-            ik_ic = incomplete_table[:, ikcs[ij], :, :, :].reshape(batch_size, num_kc, tag_num, tag_num, valency_num)
-            kj_cc = complete_table[:, kjcs[ij], :, :].reshape(batch_size, num_kc, 1, tag_num, valency_num)
-            span_c = ik_ic + kj_cc[:, :, :, :, 0].reshape(batch_size, num_kc, 1, tag_num, 1)
-            span_c = span_c.swapaxes(2, 3).reshape(batch_size, num_kc * tag_num, tag_num, valency_num)
-        complete_table[:, ij, :, :] = np.max(span_c, axis=1)
-        max_idx = np.argmax(span_c, axis=1)
-        complete_backtrack[:, ij, :, :] = max_idx
-
+        for dir in range(2):
+            ids, span_ikcs, span_kjcs, _, _, _, _, _ = width_index[w][dir]
+            num_span = sentence_length - w
+            if dir == 0:
+                ik_cc = complete_table[:, :, :, 0][:, span_ikcs].reshape(batch_size, num_span, w, tag_num, 1, 1)
+                kj_ic = incomplete_table[:, span_kjcs]
+                span_c = ik_cc + kj_ic
+            else:
+                ik_ic = incomplete_table[:, span_ikcs]
+                kj_cc = complete_table[:, :, :, 0][:, span_kjcs].reshape(batch_size, num_span, w, 1, tag_num, 1)
+                span_c = (ik_ic + kj_cc).swapaxes(3, 4)
+            span_c = span_c.reshape(batch_size, num_span, w * tag_num, tag_num, valency_num)
+            complete_table[:, ids], complete_backtrack[:, ids] = _max_argmax(span_c, 2)
+
+    return batch_backtracking(incomplete_backtrack, complete_backtrack, sentence_length, tag_num)
+
+
+def batch_backtracking(incomplete_backtrack, complete_backtrack, sentence_length, tag_num):
+    # Decode all sentences of the batch at once. The frontier holds the spans of the best derivations that are still
+    # to be expanded, one row per (sentence, span); each step replaces every span by its two sub-spans.
+    batch_size = incomplete_backtrack.shape[0]
+    index = utils.get_span_index(sentence_length)
+    span_left, span_right, span_dir = index.span_left, index.span_right, index.span_dir
+    ikcs, ikis, kjcs, kjis = index.ikcs, index.ikis, index.kjcs, index.kjis
     tags = np.zeros((batch_size, sentence_length)).astype(int)
     heads = -np.ones((batch_size, sentence_length))
     head_valences = np.zeros((batch_size, sentence_length))
     valences = np.zeros((batch_size, sentence_length, 2))
-    root_id = span_2_id[(0, sentence_length - 1, 1)]
-    for s in range(batch_size):
-        batch_backtracking(incomplete_backtrack, complete_backtrack, root_id, 0, 0, 0, 1, tags, heads, head_valences,
-                           valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, s)
+    root_id = index.root_id
+    sen_id = np.arange(batch_size)
+    span_id = np.full(batch_size, root_id)
+    l_tag = np.zeros(batch_size, dtype=int)
+    r_tag = np.zeros(batch_size, dtype=int)
+    decision_valence = np.zeros(batch_size, dtype=int)
+    complete = np.ones(batch_size, dtype=bool)
+    while len(sen_id) > 0:
+        l, r, dir = span_left[span_id], span_right[span_id], span_dir[span_id]
+        basic = l == r
+        valences[sen_id[basic], l[basic], dir[basic]] = decision_valence[basic]
+        frontier = ~basic
+        sen_id, span_id, l_tag, r_tag, decision_valence, complete, l, r, dir = \
+            [a[frontier] for a in (sen_id, span_id, l_tag, r_tag, decision_valence, complete, l, r, dir)]
+        left_dir = dir == 0
+        # complete spans are split by backtrack index k_span * tag_num + k_tag, incomplete spans by k_span only
+        k = complete_backtrack[sen_id, span_id, np.where(left_dir, r_tag, l_tag), decision_valence]
+        k_span, k_tag = utils.get_index(tag_num, k)
+        k_span = np.where(complete, k_span, incomplete_backtrack[sen_id, span_id, l_tag, r_tag, decision_valence])
+        k_tag = np.where(complete, k_tag, 0)
+        # incomplete spans fix the head of their child
+        incomplete = ~complete
+        child = np.where(left_dir, l, r)[incomplete]
+        heads[sen_id[incomplete], child] = np.where(left_dir, r, l)[incomplete]
+        tags[sen_id[incomplete], child] = np.where(left_dir, l_tag, r_tag)[incomplete]
+        head_valences[sen_id[incomplete], child] = decision_valence[incomplete]
+
+        left_span_id = np.where(complete, ikcs[span_id, k_span], ikis[span_id, k_span])
+        left_l_tag = np.where(complete & left_dir, 0, l_tag)
+        left_r_tag = np.where(complete, k_tag, 0)
+        left_valence = np.where(complete, np.where(left_dir, 0, decision_valence), np.where(left_dir, 0, 1))
+        left_complete = incomplete | left_dir
+        right_span_id = np.where(complete, kjcs[span_id, k_span], kjis[span_id, k_span])
+        right_l_tag = np.where(complete, k_tag, 0)
+        right_r_tag = np.where(complete & ~left_dir, 0, r_tag)
+        right_valence = np.where(complete, np.where(left_dir, decision_valence, 0), np.where(left_dir, 1, 0))
+        right_complete = incomplete | ~left_dir
+
+        sen_id = np.concatenate((sen_id, sen_id))
+        span_id = np.concatenate((left_span_id, right_span_id))
+        l_tag = np.concatenate((left_l_tag, right_l_tag))
+        r_tag = np.concatenate((left_r_tag, right_r_tag))
+        decision_valence = np.concatenate((left_valence, right_valence))
+        complete = np.concatenate((left_complete, right_complete))
 
     return (heads, tags, head_valences, valences)
 
 
-def batch_backtracking(incomplete_backtrack, complete_backtrack, span_id, l_tag, r_tag, decision_valence, complete,
-                       tags, heads, head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num,
-                       sen_id):
-    (l, r, dir) = id_2_span[span_id]
-    if l == r:
-        valences[sen_id, l, dir] = decision_valence
-        return
-    if complete:
-        if dir == 0:
-            k = complete_backtrack[sen_id, span_id, r_tag, decision_valence]
-            # print 'k is ', k, ' complete left'
-            k_span, k_tag = utils.get_index(tag_num, k)
-            left_span_id = ikcs[span_id][k_span]
-            right_span_id = kjcs[span_id][k_span]
-            batch_backtracking(incomplete_backtrack, complete_backtrack, left_span_id, 0, k_tag, 0, 1, tags, heads,
-                               head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, sen_id)
-            batch_backtracking(incomplete_backtrack, complete_backtrack, right_span_id, k_tag, r_tag, decision_valence,
-                               0, tags, heads, head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id,
-                               tag_num, sen_id)
-            return
-        else:
-            num_k = len(ikcs[span_id])
-            k = complete_backtrack[sen_id, span_id, l_tag, decision_valence]
-            # print 'k is ', k, ' complete right'
-            k_span, k_tag = utils.get_index(tag_num, k)
-            left_span_id = ikcs[span_id][k_span]
-            right_span_id = kjcs[span_id][k_span]
-            batch_backtracking(incomplete_backtrack, complete_backtrack, left_span_id, l_tag, k_tag, decision_valence,
-                               0, tags, heads, head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id,
-                               tag_num, sen_id)
-            batch_backtracking(incomplete_backtrack, complete_backtrack, right_span_id, k_tag, 0, 0, 1, tags, heads,
-                               head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, sen_id)
-            return
-    else:
-        if dir == 0:
-
-            k = incomplete_backtrack[sen_id, span_id, l_tag, r_tag, decision_valence]
-            # print 'k is ', k, ' incomplete left'
-            heads[sen_id, l] = r
-            tags[sen_id, l] = l_tag
-            head_valences[sen_id, l] = decision_valence
-            left_span_id = ikis[span_id][k]
-            right_span_id = kjis[span_id][k]
-            batch_backtracking(incomplete_backtrack, complete_backtrack, left_span_id, l_tag, 0, 0, 1, tags, heads,
-                               head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, sen_id)
-            batch_backtracking(incomplete_backtrack, complete_backtrack, right_span_id, 0, r_tag, 1, 1, tags, heads,
-                               head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, sen_id)
-            return
-        else:
-            k = incomplete_backtrack[sen_id, span_id, l_tag, r_tag, decision_valence]
-            # print 'k is', k, ' incomplete right'
-            heads[sen_id, r] = l
-            tags[sen_id, r] = r_tag
-            head_valences[sen_id, r] = decision_valence
-            left_span_id = ikis[span_id][k]
-            right_span_id = kjis[span_id][k]
-            batch_backtracking(incomplete_backtrack, complete_backtrack, left_span_id, l_tag, 0, 1, 1, tags, heads,
-                               head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, sen_id)
-            batch_backtracking(incomplete_backtrack, complete_backtrack, right_span_id, 0, r_tag, 0, 1, tags, heads,
-                               head_valences, valences, ikcs, ikis, kjcs, kjis, id_2_span, span_2_id, tag_num, sen_id)
-            return
-
-
 def batch_inside(batch_scores, batch_decision_score, valency_num, cvalency_num):
     batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
-    inside_complete_table = np.zeros((batch_size, sentence_length * sentence_length * 2, tag_num, valency_num))
-    inside_incomplete_table = np.zeros(
-        (batch_size, sentence_length * sentence_length * 2, tag_num, tag_num, valency_num))
-    span_2_id, id_2_span, ijss, ikcs, ikis, kjcs, kjis, basic_span = utils.constituent_index(sentence_length,
-                                                                                             False)
+    index = utils.get_span_index(sentence_length)
+    width_index = index.widths
+    chart_size = index.chart_size
+    inside_complete_table = np.zeros((batch_size, chart_size, tag_num, valency_num))
+    inside_incomplete_table = np.zeros((batch_size, chart_size, tag_num, tag_num, valency_num))
     inside_complete_table.fill(-np.inf)
     inside_incomplete_table.fill(-np.inf)
 
-    for ii in basic_span:
-        (i, i, dir) = id_2_span[ii]
-        inside_complete_table[:, ii, :, :] = batch_decision_score[:, i, :, dir, :, 0]
+    inside_complete_table[:, index.basic_span] = batch_decision_score[:, :, :, :, :, 0].transpose(0, 1, 3, 2, 4)[
+                                                 :, index.basic_pos, index.basic_dir]
 
-    for ij in ijss:
-        (l, r, dir) = id_2_span[ij]
+    # All spans of one width are built together: incomplete spans only need narrower complete spans, complete spans
+    # need narrower complete spans and incomplete spans up to the same width
+    for w in range(1, sentence_length):
         # two complete span to form an incomplete span
-        num_ki = len(ikis[ij])
-        inside_ik_ci = inside_complete_table[:, ikis[ij], :, :].reshape(batch_size, num_ki, tag_num, 1, valency_num)
-        inside_kj_ci = inside_complete_table[:, kjis[ij], :, :].reshape(batch_size, num_ki, 1, tag_num, valency_num)
-        if dir == 0:
-            span_inside_i = inside_ik_ci[:, :, :, :, 0].reshape(batch_size, num_ki, tag_num, 1, 1) \
-                            + inside_kj_ci[:, :, :, :, 1].reshape(batch_size, num_ki, 1, tag_num, 1) \
-                            + batch_scores[:, r, l, :, :, :].swapaxes(2, 1).reshape(batch_size, 1, tag_num, tag_num,
-                                                                                    cvalency_num) \
-                            + batch_decision_score[:, r, :, dir, :, 1].reshape(batch_size, 1, 1, tag_num, valency_num)
-
-            # swap head-child to left-right position
-        else:
-            span_inside_i = inside_ik_ci[:, :, :, :, 1].reshape(batch_size, num_ki, tag_num, 1, 1) \
-                            + inside_kj_ci[:, :, :, :, 0].reshape(batch_size, num_ki, 1, tag_num, 1) \
-                            + batch_scores[:, l, r, :, :, :].reshape(batch_size, 1, tag_num, tag_num, cvalency_num) \
-                            + batch_decision_score[:, l, :, dir, :, 1].reshape(batch_size, 1, tag_num, 1, valency_num)
-
-        inside_incomplete_table[:, ij, :, :, :] = logsumexp(span_inside_i, axis=1)
+        for dir in range(2):
+            ids = width_index[w][dir][0]
+            span_inside_i = _incomplete_span_score(inside_complete_table, batch_scores, batch_decision_score, w, dir,
+                                                   width_index[w][dir], valency_num, cvalency_num)
+            inside_incomplete_table[:, ids] = _logsumexp(span_inside_i, axis=(2,))
 
         # one complete span and one incomplete span to form bigger complete span
-        num_kc = len(ikcs[ij])
-        if dir == 0:
-            inside_ik_cc = inside_complete_table[:, ikcs[ij], :, :].reshape(batch_size, num_kc, tag_num, 1, valency_num)
-            inside_kj_ic = inside_incomplete_table[:, kjcs[ij], :, :, :].reshape(batch_size, num_kc, tag_num, tag_num,
-                                                                                 valency_num)
-            span_inside_c = inside_ik_cc[:, :, :, :, 0].reshape(batch_size, num_kc, tag_num, 1, 1) + inside_kj_ic
-            span_inside_c = span_inside_c.reshape(batch_size, num_kc * tag_num, tag_num, valency_num)
-            inside_complete_table[:, ij, :, :] = logsumexp(span_inside_c, axis=1)
-        else:
-            inside_ik_ic = inside_incomplete_table[:, ikcs[ij], :, :, :].reshape(batch_size, num_kc, tag_num, tag_num,
-                                                                                 valency_num)
-            inside_kj_cc = inside_complete_table[:, kjcs[ij], :, :].reshape(batch_size, num_kc, 1, tag_num, valency_num)
-            span_inside_c = inside_ik_ic + inside_kj_cc[:, :, :, :, 0].reshape(batch_size, num_kc, 1, tag_num, 1)
-            span_inside_c = span_inside_c.swapaxes(3, 2).reshape(batch_size, num_kc * tag_num, tag_num, valency_num)
-            # swap the left-right position since the left tags are to be indexed
-            inside_complete_table[:, ij, :, :] = logsumexp(span_inside_c, axis=1)
-
-    final_id = span_2_id[(0, sentence_length - 1, 1)]
-    partition_score = inside_complete_table[:, final_id, 0, 0]
+        for dir in range(2):
+            ids, span_ikcs, span_kjcs, _, _, _, _, _ = width_index[w][dir]
+            num_span = sentence_length - w
+            if dir == 0:
+                inside_ik_cc = inside_complete_table[:, :, :, 0][:, span_ikcs].reshape(batch_size, num_span, w,
+                                                                                      tag_num, 1, 1)
+                inside_kj_ic = inside_incomplete_table[:, span_kjcs]
+                span_inside_c = inside_ik_cc + inside_kj_ic
+                inside_complete_table[:, ids] = _logsumexp(span_inside_c, axis=(2, 3))
+            else:
+                inside_ik_ic = inside_incomplete_table[:, span_ikcs]
+                inside_kj_cc = inside_complete_table[:, :, :, 0][:, span_kjcs].reshape(batch_size, num_span, w, 1,
+                                                                                      tag_num, 1)
+                span_inside_c = inside_ik_ic + inside_kj_cc
+                # sum out the split point and the tags of the right child
+                inside_complete_table[:, ids] = _logsumexp(span_inside_c, axis=(2, 4))
+
+    partition_score = inside_complete_table[:, index.root_id, 0, 0]
 
     return inside_complete_table, inside_incomplete_table, partition_score
 
 
+def _incomplete_span_score(complete_table, batch_scores, batch_decision_score, w, dir, span_index, valency_num,
+                           cvalency_num):
+    # Scores of all ways to build the incomplete spans of width w and direction dir from two complete spans,
+    # shaped (batch, span, split point, left tag, right tag, valence); padded split points score -inf
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    ids, _, _, span_ikis, span_kjis, span_mask, heads, children = span_index
+    num_span = sentence_length - w
+    # the complete span of the head takes decision valence 1, the one of the child decision valence 0
+    ik_ci = complete_table[:, :, :, dir][:, span_ikis].reshape(batch_size, num_span, w, tag_num, 1, 1)
+    kj_ci = complete_table[:, :, :, 1 - dir][:, span_kjis].reshape(batch_size, num_span, w, 1, tag_num, 1)
+    span_decision_score = batch_decision_score[:, :, :, dir, :, 1][:, heads]
+    if dir == 0:
+        # swap head-child to left-right position
+        span_score = batch_scores[:, heads, children].swapaxes(2, 3)
+        span_decision_score = span_decision_score.reshape(batch_size, num_span, 1, 1, tag_num, valency_num)
+    else:
+        span_score = batch_scores[:, heads, children]
+        span_decision_score = span_decision_score.reshape(batch_size, num_span, 1, tag_num, 1, valency_num)
+    span_i = ik_ci + kj_ci + span_score.reshape(batch_size, num_span, 1, tag_num, tag_num, cvalency_num) \
+             + span_decision_score
+    if not span_mask.all():
+        span_i[:, ~span_mask] = -np.inf
+    return span_i
+
+
 def batch_outside(inside_complete_table, inside_incomplete_table, batch_scores, batch_decision_scores, valency_num,
                   cvalency_num):
     batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
-    outside_complete_table = np.zeros((batch_size, sentence_length * sentence_length * 2, tag_num, valency_num))
-    outside_incomplete_table = np.zeros(
-        (batch_size, sentence_length * sentence_length * 2, tag_num, tag_num, valency_num))
-    span_2_id, id_2_span, ijss, ikcs, ikis, kjcs, kjis, basic_span = utils.constituent_index(sentence_length, False)
-    outside_complete_table.fill(-np.inf)
-    outside_incomplete_table.fill(-np.inf)
-
-    root_id = span_2_id.get((0, sentence_length - 1, 1))
-    outside_complete_table[:, root_id, 0, 0] = 0.0
-
-    complete_span_used_0 = set()
-    complete_span_used_1 = set()
-    incomplete_span_used = set()
-    complete_span_used_0.add(root_id)
-
-    for ij in reversed(ijss):
-        (l, r, dir) = id_2_span[ij]
+    index = utils.get_span_index(sentence_length)
+    width_index = index.widths
+    chart_size = index.chart_size
+    # The pass works on span-major copies of the tables, (span, batch, ...), so that the sub-spans gathered and
+    # updated for one width are contiguous blocks of memory rather than a few entries in every sentence's row
+    inside_complete_table = np.ascontiguousarray(np.moveaxis(inside_complete_table, 1, 0))
+    inside_incomplete_table = np.ascontiguousarray(np.moveaxis(inside_incomplete_table, 1, 0))
+    outside_complete_table = np.full((chart_size, batch_size, tag_num, valency_num), -np.inf)
+    outside_incomplete_table = np.full((chart_size, batch_size, tag_num, tag_num, valency_num), -np.inf)
+
+    outside_complete_table[index.root_id, :, 0, 0] = 0.0
+
+    # Spans of one width only pass outside scores to narrower spans, or from complete to incomplete spans of the
+    # same width. Within one width and direction, every split point updates a distinct span, so contributions can
+    # be accumulated in bulk without repeated indices.
+    for w in range(sentence_length - 1, 0, -1):
+        num_span = sentence_length - w
         # complete span consists of one incomplete span and one complete span
-        num_kc = len(ikcs[ij])
-        if dir == 0:
-            outside_ij_cc = outside_complete_table[:, ij, :, :].reshape(batch_size, 1, 1, tag_num, valency_num)
-            inside_kj_ic = inside_incomplete_table[:, kjcs[ij], :, :, :].reshape(batch_size, num_kc, tag_num, tag_num,
-                                                                                 valency_num)
-            inside_ik_cc = inside_complete_table[:, ikcs[ij], :, :].reshape(batch_size, num_kc, tag_num, 1, valency_num)
-            outside_ik_cc = (outside_ij_cc + inside_kj_ic).swapaxes(2, 3)
-            # swap left-right position since right tags are to be indexed
-            outside_kj_ic = outside_ij_cc + inside_ik_cc[:, :, :, :, 0].reshape(batch_size, num_kc, tag_num, 1, 1)
-            for i in range(num_kc):
-                ik = ikcs[ij][i]
-                kj = kjcs[ij][i]
-                outside_ik_cc_i = logsumexp(outside_ik_cc[:, i, :, :, :], axis=(1, 3))
-                if ik in complete_span_used_0:
-                    outside_complete_table[:, ik, :, 0] = np.logaddexp(
-                        outside_complete_table[:, ik, :, 0], outside_ik_cc_i)
-                else:
-                    outside_complete_table[:, ik, :, 0] = np.copy(outside_ik_cc_i)
-                    complete_span_used_0.add(ik)
-
-                if kj in incomplete_span_used:
-                    outside_incomplete_table[:, kj, :, :, :] = np.logaddexp(outside_incomplete_table[:, kj, :, :, :],
-                                                                            outside_kj_ic[:, i, :, :, :])
-                else:
-                    outside_incomplete_table[:, kj, :, :, :] = np.copy(outside_kj_ic[:, i, :, :, :])
-                    incomplete_span_used.add(kj)
-        else:
-            outside_ij_cc = outside_complete_table[:, ij, :, :].reshape(batch_size, 1, tag_num, 1, valency_num)
-            inside_ik_ic = inside_incomplete_table[:, ikcs[ij], :, :, :].reshape(batch_size, num_kc, tag_num, tag_num,
-                                                                                 valency_num)
-            inside_kj_cc = inside_complete_table[:, kjcs[ij], :, :].reshape(batch_size, num_kc, 1, tag_num, valency_num)
-            outside_kj_cc = outside_ij_cc + inside_ik_ic
-            outside_ik_ic = outside_ij_cc + inside_kj_cc[:, :, :, :, 0].reshape(batch_size, num_kc, 1, tag_num, 1)
-            for i in range(num_kc):
-                kj = kjcs[ij][i]
-                ik = ikcs[ij][i]
-                outside_kj_cc_i = logsumexp(outside_kj_cc[:, i, :, :, :], axis=(1, 3))
-                if kj in complete_span_used_0:
-                    outside_complete_table[:, kj, :, 0] = np.logaddexp(outside_complete_table[:, kj, :, 0],
-                                                                       outside_kj_cc_i)
-                else:
-                    outside_complete_table[:, kj, :, 0] = np.copy(outside_kj_cc_i)
-                    complete_span_used_0.add(kj)
-
-                if ik in incomplete_span_used:
-                    outside_incomplete_table[:, ik, :, :, :] = np.logaddexp(outside_incomplete_table[:, ik, :, :, :],
-                                                                            outside_ik_ic[:, i, :, :, :])
-                else:
-                    outside_incomplete_table[:, ik, :, :, :] = np.copy(outside_ik_ic[:, i, :, :, :])
-                    incomplete_span_used.add(ik)
-
-        # incomplete span consists of two complete spans
-        num_ki = len(ikis[ij])
-
-        outside_ij_ii = outside_incomplete_table[:, ij, :, :, :].reshape(batch_size, 1, tag_num, tag_num, valency_num)
-        inside_ik_ci = inside_complete_table[:, ikis[ij], :, :].reshape(batch_size, num_ki, tag_num, 1, valency_num)
-        inside_kj_ci = inside_complete_table[:, kjis[ij], :].reshape(batch_size, num_ki, 1, tag_num, valency_num)
-
-        if dir == 0:
-            outside_ik_ci_0 = outside_ij_ii + inside_kj_ci[:, :, :, :, 1].reshape(batch_size, num_ki, 1, tag_num, 1) + \
-                              batch_scores[:, r, l, :, :, :].swapaxes(1, 2). \
-                                  reshape(batch_size, 1, tag_num, tag_num, cvalency_num) + \
-                              batch_decision_scores[:, r, :, dir, :, 1].reshape(batch_size, 1, 1, tag_num, valency_num)
-
-            outside_kj_ci_1 = outside_ij_ii + inside_ik_ci[:, :, :, :, 0].reshape(batch_size, num_ki, tag_num, 1, 1) + \
-                              batch_scores[:, r, l, :, :, :].swapaxes(1, 2). \
-                                  reshape(batch_size, 1, tag_num, tag_num, cvalency_num) + \
-                              batch_decision_scores[:, r, :, dir, :, 1].reshape(batch_size, 1, 1, tag_num, valency_num)
-        else:
-            outside_ik_ci_1 = outside_ij_ii + inside_kj_ci[:, :, :, :, 0].reshape(batch_size, num_ki, 1, tag_num, 1) \
-                              + batch_scores[:, l, r, :, :, :].reshape(batch_size, 1, tag_num, tag_num, cvalency_num) + \
-                              batch_decision_scores[:, l, :, dir, :, 1].reshape(batch_size, 1, tag_num, 1, valency_num)
-            outside_kj_ci_0 = outside_ij_ii + inside_ik_ci[:, :, :, :, 1].reshape(batch_size, num_ki, tag_num, 1, 1) + \
-                              batch_scores[:, l, r, :, :, :].reshape(batch_size, 1, tag_num, tag_num, cvalency_num) + \
-                              batch_decision_scores[:, l, :, dir, :, 1].reshape(batch_size, 1, tag_num, 1, valency_num)
-
-        for i in range(num_ki):
-            ik = ikis[ij][i]
-            kj = kjis[ij][i]
+        for dir in range(2):
+            ids, span_ikcs, span_kjcs, _, _, _, _, _ = width_index[w][dir]
             if dir == 0:
-                outside_ik_ci_i_0 = logsumexp(outside_ik_ci_0[:, i, :, :, :], axis=(2, 3))
-                outside_kj_ci_i_1 = logsumexp(outside_kj_ci_1[:, i, :, :, :], axis=(1, 3))
+                outside_ij_cc = outside_complete_table[ids].reshape(num_span, 1, batch_size, 1, tag_num, valency_num)
+                inside_kj_ic = inside_incomplete_table[span_kjcs]
+                inside_ik_cc = inside_complete_table[span_ikcs, :, :, 0].reshape(num_span, w, batch_size, tag_num,
+                                                                                 1, 1)
+                outside_ik_cc = _logsumexp(outside_ij_cc + inside_kj_ic, axis=(4, 5))
+                outside_kj_ic = outside_ij_cc + inside_ik_cc
+                _logaddexp_at(outside_complete_table[:, :, :, 0], span_ikcs, outside_ik_cc)
+                _logaddexp_at(outside_incomplete_table, span_kjcs, outside_kj_ic)
             else:
-                outside_ik_ci_i_1 = logsumexp(outside_ik_ci_1[:, i, :, :, :], axis=(2, 3))
-                outside_kj_ci_i_0 = logsumexp(outside_kj_ci_0[:, i, :, :, :], axis=(1, 3))
-            if dir == 0:
-                if ik in complete_span_used_0:
-                    outside_complete_table[:, ik, :, 0] = np.logaddexp(outside_complete_table[:, ik, :, 0],
-                                                                       outside_ik_ci_i_0)
-                else:
-                    outside_complete_table[:, ik, :, 0] = np.copy(outside_ik_ci_i_0)
-                    complete_span_used_0.add(ik)
-
-                if kj in complete_span_used_1:
-                    outside_complete_table[:, kj, :, 1] = np.logaddexp(outside_complete_table[:, kj, :, 1],
-                                                                       outside_kj_ci_i_1)
-                else:
-                    outside_complete_table[:, kj, :, 1] = np.copy(outside_kj_ci_i_1)
-                    complete_span_used_1.add(kj)
+                outside_ij_cc = outside_complete_table[ids].reshape(num_span, 1, batch_size, tag_num, 1, valency_num)
+                inside_ik_ic = inside_incomplete_table[span_ikcs]
+                inside_kj_cc = inside_complete_table[span_kjcs, :, :, 0].reshape(num_span, w, batch_size, 1,
+                                                                                 tag_num, 1)
+                outside_kj_cc = _logsumexp(outside_ij_cc + inside_ik_ic, axis=(3, 5))
+                outside_ik_ic = outside_ij_cc + inside_kj_cc
+                _logaddexp_at(outside_complete_table[:, :, :, 0], span_kjcs, outside_kj_cc)
+                _logaddexp_at(outside_incomplete_table, span_ikcs, outside_ik_ic)
 
+        # incomplete span consists of two complete spans
+        for dir in range(2):
+            ids, _, _, span_ikis, span_kjis, span_mask, heads, children = width_index[w][dir]
+            span_decision_scores = batch_decision_scores[:, :, :, dir, :, 1][:, heads]
+            if dir == 0:
+                # swap head-child to left-right position
+                span_scores = batch_scores[:, heads, children, :, :, :].swapaxes(2, 3)
+                span_decision_scores = span_decision_scores.reshape(batch_size, num_span, 1, tag_num, valency_num)
             else:
-                if ik in complete_span_used_1:
-                    outside_complete_table[:, ik, :, 1] = np.logaddexp(outside_complete_table[:, ik, :, 1],
-                                                                       outside_ik_ci_i_1)
-                else:
-                    outside_complete_table[:, ik, :, 1] = np.copy(outside_ik_ci_i_1)
-                    complete_span_used_1.add(ik)
-
-                if kj in complete_span_used_0:
-                    outside_complete_table[:, kj, :, 0] = np.logaddexp(outside_complete_table[:, kj, :, 0],
-                                                                       outside_kj_ci_i_0)
-                else:
-                    outside_complete_table[:, kj, :, 0] = np.copy(outside_kj_ci_i_0)
-                    complete_span_used_0.add(kj)
-
-    return outside_complete_table, outside_incomplete_table
+                span_scores = batch_scores[:, heads, children, :, :, :]
+                span_decision_scores = span_decision_scores.reshape(batch_size, num_span, tag_num, 1, valency_num)
+            span_scores = span_scores.reshape(batch_size, num_span, tag_num, tag_num, cvalency_num) \
+                          + span_decision_scores
+            outside_ij_ii = (outside_incomplete_table[ids] + span_scores.swapaxes(0, 1)).reshape(
+                num_span, 1, batch_size, tag_num, tag_num, valency_num)
+            # the complete span of the head takes decision valence 1, the one of the child decision valence 0
+            inside_ik_ci = inside_complete_table[span_ikis, :, :, dir].reshape(num_span, w, batch_size, tag_num, 1, 1)
+            inside_kj_ci = inside_complete_table[span_kjis, :, :, 1 - dir].reshape(num_span, w, batch_size, 1,
+                                                                                   tag_num, 1)
+            outside_ik_ci = _logsumexp(outside_ij_ii + inside_kj_ci, axis=(4, 5))
+            outside_kj_ci = _logsumexp(outside_ij_ii + inside_ik_ci, axis=(3, 5))
+            _logaddexp_at(outside_complete_table[:, :, :, dir], span_ikis[span_mask], outside_ik_ci[span_mask])
+            _logaddexp_at(outside_complete_table[:, :, :, 1 - dir], span_kjis[span_mask], outside_kj_ci[span_mask])
+
+    return np.moveaxis(outside_complete_table, 0, 1), np.moveaxis(outside_incomplete_table, 0, 1)
+
+
+def _logaddexp_at(table, span_ids, span_scores):
+    # span_ids index the first axis of a span-major table and must not contain duplicates
+    table[span_ids] = _logaddexp(table[span_ids], span_scores)
+
+
+def _logaddexp(a, b):
+    # same as np.logaddexp, which is several times slower than adding log1p(exp(-|a - b|)) to the larger side with
+    # in-place ufuncs; entries that are -inf on both sides stay -inf
+    ab_max = np.maximum(a, b)
+    diff = np.minimum(a, b)
+    with np.errstate(invalid='ignore'):
+        diff -= ab_max
+    diff[np.isnan(diff)] = -np.inf
+    np.exp(diff, out=diff)
+    np.log1p(diff, out=diff)
+    diff += ab_max
+    return diff
+
+
+def _logsumexp(x, axis):
+    # numpy reduces short trailing axes very slowly, so the reduced axes are moved to the front and flattened
+    x = np.moveaxis(x, axis, tuple(range(len(axis))))
+    kept_shape = x.shape[len(axis):]
+    x = np.ascontiguousarray(x).reshape((-1,) + kept_shape)
+    x_max = np.max(x, axis=0)
+    x_max[~np.isfinite(x_max)] = 0
+    x = x - x_max
+    np.exp(x, out=x)
+    x_sum = np.sum(x, axis=0)
+    with np.errstate(divide='ignore'):
+        np.log(x_sum, out=x_sum)
+    x_sum += x_max
+    return x_sum
+
+
+def _max_argmax(x, axis):
+    # max and first argmax along one axis, which is moved to the front for the same reason as in _logsumexp
+    x = np.ascontiguousarray(np.moveaxis(x, axis, 0))
+    return np.max(x, axis=0), np.argmax(x, axis=0)
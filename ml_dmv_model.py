@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 
 import eisner_for_dmv
+import torch_eisner_for_dmv
 import utils
 
 
@@ -15,10 +16,59 @@ import utils
 # from torch_model.NN_trainer import *
 
 
+def cached_log_param(name):
+    # Parameter attribute whose log table is built on first use by log_param and dropped whenever the parameter is
+    # reassigned. Parameters are only ever replaced as a whole (init_param, em_m, neural prediction). With
+    # shared_param, new values are copied into the parameter's shared array instead of replacing it.
+    def get_param(self):
+        return self.__dict__[name]
+
+    def set_param(self, value):
+        if value is not None and self.shared_param:
+            param = self.__dict__.get(name)
+            if param is None or param.shape != value.shape:
+                param = utils.alloc_like(value, True, self.memmap_dir, name)
+            if param is not value:
+                param[...] = value
+            value = param
+        self.__dict__[name] = value
+        self.__dict__.pop('log_' + name, None)
+
+    return property(get_param, set_param)
+
+
+@utils.memoize
+def _km_arc_weight(word_num):
+    # Harmonic initializer weights of a sentence with word_num words, tokens indexed from 0. Every child spreads
+    # (word_num - 1) / word_num over its heads in proportion to 1 / distance. Returns the child, head, direction
+    # and weight of every arc in (child, head) order, and per head word and direction the total weight of its arcs.
+    # Running sums keep the summation order of the token loops.
+    token = np.arange(word_num)
+    distance = np.abs(token[None, :] - token[:, None]).astype(float)
+    is_arc = distance > 0
+    inverse_distance = np.where(is_arc, 1. / np.where(is_arc, distance, 1), 0)
+    child_sum = np.cumsum(inverse_distance, axis=1)[:, -1]
+    scale = np.where(child_sum > 0, float(word_num - 1) / word_num * (1. / np.where(child_sum > 0, child_sum, 1)), 0)
+    weight = np.where(is_arc, inverse_distance * scale[:, None], 0)
+    # child j left of head i has direction 0
+    left = token[:, None] < token[None, :]
+    change = np.stack([np.cumsum(np.where(left, weight, 0), axis=0)[-1],
+                       np.cumsum(np.where(left | ~is_arc, 0, weight), axis=0)[-1]], axis=1)
+    child, head = np.nonzero(is_arc)
+    return child, head, np.where(left[child, head], 0, 1), weight[child, head], change
+
+
 class ml_dmv_model(nn.Module):
+    trans_param = cached_log_param('trans_param')
+    decision_param = cached_log_param('decision_param')
+    sentence_trans_param = cached_log_param('sentence_trans_param')
+
     def __init__(self, pos, sentence_map, languages, language_map, data_size, options):
         super(ml_dmv_model, self).__init__()
         self.options = options
+        # keep parameter arrays in shared memory (or memory-mapped files) for multiprocess E-steps
+        self.shared_param = options.shared_param
+        self.memmap_dir = options.memmap_dir
         self.count_smoothing = options.count_smoothing
         self.param_smoothing = options.param_smoothing
         self.pos = pos
@@ -30,6 +80,8 @@ class ml_dmv_model(nn.Module):
         self.from_decision = {}
         self.id_to_pos = {}
         self.em_type = options.em_type
+        self.estep_engine = options.estep_engine
+        self.eisner_backend = options.eisner_backend
         self.trans_counter = None
         self.function_mask = options.function_mask
         self.use_neural = options.use_neural
@@ -41,10 +93,9 @@ class ml_dmv_model(nn.Module):
         self.sentence_predict = options.sentence_predict
         self.concat_all = options.concat_all
         if self.sentence_predict:
-            self.sentence_counter = {}
-            self.sentence_decision_counter = {}
-            self.sentence_trans_param = np.zeros((data_size, len(list(pos.keys())), len(list(pos.keys())), 2, self.cvalency))
-            self.sentence_decision_param = np.zeros((data_size, len(list(pos.keys())), 2, self.dvalency, 2))
+            # only head POS that occur in a sentence get parameters for that sentence
+            self.sentence_trans_param = utils.sentence_param([sentence_map[s] for s in range(data_size)],
+                                                             len(list(pos.keys())), self.cvalency)
         else:
             self.sentence_trans_param = None
         # head_pos,child_pos,direction,child_valence,languages
@@ -62,8 +113,8 @@ class ml_dmv_model(nn.Module):
             self.function_set.add("SCONJ")
 
         if self.use_neural:
-            self.rule_samples = list()
-            self.decision_samples = list()
+            self.rule_samples = utils.sample_buffer(utils.RULE_SAMPLE_FIELDS)
+            self.decision_samples = utils.sample_buffer(utils.DECISION_SAMPLE_FIELDS)
 
         for p in list(pos.keys()):
             self.id_to_pos[self.pos[p]] = p
@@ -72,50 +123,50 @@ class ml_dmv_model(nn.Module):
     def init_param(self, data):
         root_idx = self.pos['ROOT-POS']
         count_smoothing = self.count_smoothing
+        pos_num = len(self.pos)
+        lan_num = len(self.languages)
         # pos_tag,direction,valence,decision,languages
-        norm_counter = np.zeros((len(self.pos), 2, self.dvalency, 2, len(self.languages)))
-        s_counter = 0
-        for sentence in data:
-            word_num = sentence.size - 1
-            change = np.zeros((word_num, 2))
+        norm_counter = np.zeros((pos_num, 2, self.dvalency, 2, lan_num))
+        # Harmonic arc mass of all sentences, gathered in the order of the token loops it replaces so that the
+        # sums below add up in the same order: root arcs, (child, head) arcs and per-word (pos, dir) changes
+        root_index, root_weight = [], []
+        arc_index, arc_weight = [], []
+        word_index, word_change = [], []
+        corpus_pos = data.map_pos(self.pos)
+        for s_counter in range(len(data)):
+            # words of the sentence, root left out
+            pos_id = corpus_pos[data.offsets[s_counter] + 1:data.offsets[s_counter + 1]]
+            word_num = len(pos_id)
+            if word_num == 0:
+                continue
             lan_id = self.languages[self.language_map[s_counter]]
-            for i, entry in enumerate(sentence.entries):
-                if i == 0:
-                    continue
-                pos_id = self.pos[entry.pos]
-                self.trans_param[root_idx, pos_id, 1, :, lan_id] += 1. / word_num
-            for j, m_entry in enumerate(sentence.entries):
-                if j == 0:
-                    continue
-                child_sum = 0
-                for i in range(sentence.size):
-                    if i == 0:
-                        continue
-                    if i == j:
-                        continue
-                    child_sum += 1. / abs(i - j)
-                if child_sum > 0:
-                    scale = float(word_num - 1) / word_num * (1. / child_sum)
-                else:
-                    scale = 0
-                for i, h_entry in enumerate(sentence.entries):
-                    if i == j:
-                        continue
-                    if i == 0:
-                        continue
-                    if j < i:
-                        dir = 0
-                    else:
-                        dir = 1
-                    span = abs(i - j)
-                    h_pos = h_entry.pos
-                    m_pos = m_entry.pos
-                    h_pos_id = self.pos.get(h_pos)
-                    m_pos_id = self.pos.get(m_pos)
-                    self.trans_param[h_pos_id, m_pos_id, dir, :, lan_id] += 1. / span * scale
-                    change[i - 1, dir] += 1. / span * scale
-            self.update_decision(change, norm_counter, sentence.entries, lan_id)
-            s_counter += 1
+            root_index.append(np.ravel_multi_index((pos_id, lan_id), (pos_num, lan_num)))
+            root_weight.append(np.full(word_num, 1. / word_num))
+            child, head, dir, weight, change = _km_arc_weight(word_num)
+            arc_index.append(np.ravel_multi_index((pos_id[head], pos_id[child], dir, lan_id),
+                                                  (pos_num, pos_num, 2, lan_num)))
+            arc_weight.append(weight)
+            word_index.append(np.ravel_multi_index((pos_id[:, None], np.arange(2), lan_id), (pos_num, 2, lan_num)))
+            word_change.append(change)
+        if len(root_index) > 0:
+            root_mass = np.bincount(np.concatenate(root_index), np.concatenate(root_weight),
+                                    minlength=pos_num * lan_num).reshape(pos_num, 1, lan_num)
+            arc_mass = np.bincount(np.concatenate(arc_index), np.concatenate(arc_weight),
+                                   minlength=pos_num * pos_num * 2 * lan_num).reshape(pos_num, pos_num, 2, 1, lan_num)
+            word_index = np.concatenate(word_index).ravel()
+            word_change = np.concatenate(word_change).ravel()
+            has_child = word_change > 0
+            word_count, child_count, child_mass = [
+                np.bincount(word_index, weights, minlength=pos_num * 2 * lan_num).reshape(pos_num, 2, lan_num)
+                for weights in [None, has_child, np.where(has_child, word_change, 0)]]
+            self.trans_param[root_idx, :, 1] += root_mass
+            self.trans_param += arc_mass
+            norm_counter[:, :, 0, 1] += child_count
+            norm_counter[:, :, 1, 1] -= child_count
+            norm_counter[:, :, 0, 0] -= child_count
+            norm_counter[:, :, 1, 0] += child_count
+            self.decision_param[:, :, 1, 1] += child_mass
+            self.decision_param[:, :, 0, 0] += word_count
         self.trans_param += count_smoothing
         self.decision_param += count_smoothing
         es = self.first_child_update(norm_counter)
@@ -130,22 +181,6 @@ class ml_dmv_model(nn.Module):
         self.trans_param = old_div(self.trans_param, trans_sum)
         self.decision_param = old_div(self.decision_param, decision_sum)
 
-    def update_decision(self, change, norm_counter, entries, lan_id):
-        word_num, _ = change.shape
-        for i in range(word_num):
-            pos_id = self.pos[entries[i + 1].pos]
-            for dir in range(2):
-                if change[i, dir] > 0:
-                    norm_counter[pos_id, dir, 0, 1, lan_id] += 1
-                    norm_counter[pos_id, dir, 1, 1, lan_id] += -1
-                    self.decision_param[pos_id, dir, 1, 1, lan_id] += change[i, dir]
-
-                    norm_counter[pos_id, dir, 0, 0, lan_id] += -1
-                    norm_counter[pos_id, dir, 1, 0, lan_id] += 1
-                    self.decision_param[pos_id, dir, 0, 0, lan_id] += 1
-                else:
-                    self.decision_param[pos_id, dir, 0, 0, lan_id] += 1
-
     def first_child_update(self, norm_counter):
         es = np.ones(len(self.languages))
         all_param = np.copy(self.decision_param)
@@ -161,7 +196,8 @@ class ml_dmv_model(nn.Module):
         return es
 
     def em_e(self, batch_pos, batch_lan, batch_sen, trans_counter, decision_counter, em_type):
-        batch_pos = np.array(batch_pos)
+        # sentences of the batch may differ in length, they are padded to the longest one
+        batch_pos, batch_len = utils.pad_batch_pos(batch_pos)
         # viterbi implementation is in fact not included
         if em_type == 'viterbi':
             #batch_likelihood = self.run_viterbi_estep(batch_pos, batch_lan, batch_sen, trans_counter,
@@ -169,7 +205,7 @@ class ml_dmv_model(nn.Module):
             pass
         elif em_type == 'em':
             batch_likelihood, en_like = self.run_em_estep(batch_pos, batch_lan, batch_sen, trans_counter,
-                                                          decision_counter)
+                                                          decision_counter, batch_len)
 
         return batch_likelihood, en_like
 
@@ -192,7 +228,7 @@ class ml_dmv_model(nn.Module):
         self.trans_counter = trans_counter
         return batch_likelihood
 
-    def run_em_estep(self, batch_pos, batch_lan, batch_sen, trans_counter, decision_counter):
+    def run_em_estep(self, batch_pos, batch_lan, batch_sen, trans_counter, decision_counter, batch_len=None):
         # Assign scores to each possible dependency arc
         batch_score, batch_decision_score = self.evaluate_batch_score(batch_pos, batch_sen, self.language_map,
                                                                       self.languages, None)
@@ -202,65 +238,87 @@ class ml_dmv_model(nn.Module):
         batch_score[:, :, 0, :] = -np.inf
         # Mask function tags
         if self.function_mask:
-            batch_score = self.function_to_mask(batch_score, batch_pos)
+            batch_score = self.function_to_mask(batch_score, batch_pos, batch_len)
+        if batch_len is not None:
+            self.mask_padding(batch_score, batch_decision_score, batch_len)
         batch_size, sentence_length, _, _ = batch_score.shape
         inside_batch_score = batch_score.reshape(batch_size, sentence_length, sentence_length, 1, 1, self.cvalency)
         inside_batch_decision_score = batch_decision_score.reshape(batch_size, sentence_length, 1, 2, self.dvalency, 2)
-        # Compute inside-outside table
-        inside_complete_table, inside_incomplete_table, sentence_prob = \
-            eisner_for_dmv.batch_inside(inside_batch_score, inside_batch_decision_score, self.dvalency, self.cvalency)
-        outside_complete_table, outside_incomplete_table = \
-            eisner_for_dmv.batch_outside(inside_complete_table, inside_incomplete_table, inside_batch_score,
-                                         inside_batch_decision_score, self.dvalency, self.cvalency)
+        if self.estep_engine == 'autograd':
+            # Expected counts from the gradient of the log partition, without outside tables
+            arc_count, stop_count, sentence_prob = \
+                torch_eisner_for_dmv.batch_expected_count(inside_batch_score, inside_batch_decision_score,
+                                                          self.dvalency, self.cvalency)
+        else:
+            # Compute inside-outside table
+            if self.eisner_backend == 'torch':
+                inside_batch_score = torch.from_numpy(inside_batch_score)
+                inside_batch_decision_score = torch.from_numpy(inside_batch_decision_score)
+                eisner = torch_eisner_for_dmv
+            else:
+                eisner = eisner_for_dmv
+            inside_complete_table, inside_incomplete_table, sentence_prob = \
+                eisner.batch_inside(inside_batch_score, inside_batch_decision_score, self.dvalency, self.cvalency)
+            outside_complete_table, outside_incomplete_table = \
+                eisner.batch_outside(inside_complete_table, inside_incomplete_table, inside_batch_score,
+                                     inside_batch_decision_score, self.dvalency, self.cvalency)
+            if self.eisner_backend == 'torch':
+                inside_complete_table, inside_incomplete_table, sentence_prob, outside_complete_table, \
+                outside_incomplete_table = [t.numpy() for t in (inside_complete_table, inside_incomplete_table,
+                                                                sentence_prob, outside_complete_table,
+                                                                outside_incomplete_table)]
+            arc_count, stop_count = self.expected_count(inside_incomplete_table, inside_complete_table,
+                                                        sentence_prob, outside_incomplete_table,
+                                                        outside_complete_table, sentence_length)
         # Update counters
-        batch_likelihood, en_like = self.update_pseudo_count(inside_incomplete_table, inside_complete_table,
-                                                             sentence_prob,
-                                                             outside_incomplete_table, outside_complete_table,
-                                                             trans_counter,
-                                                             decision_counter, batch_pos, batch_sen, batch_lan)
+        batch_likelihood, en_like = self.update_pseudo_count(arc_count, stop_count, sentence_prob, trans_counter,
+                                                             decision_counter, batch_pos, batch_sen, batch_lan,
+                                                             batch_len)
         return batch_likelihood, en_like
 
     def evaluate_batch_score(self, batch_pos, batch_sen, language_map, languages, eval_trans_param):
         batch_size, sentence_length = batch_pos.shape
         # batch,head,child,head_tag,child_tag
-        scores = np.zeros((batch_size, sentence_length, sentence_length, self.cvalency))
-        # batch,position,tag,direction,valency,decision
-        decision_scores = np.zeros((batch_size, sentence_length, 2, self.dvalency, 2))
-        scores.fill(-np.inf)
-        decision_scores.fill(-np.inf)
-        for s in range(batch_size):
-            sentence_id = batch_sen[s]
-            lan_id = languages[language_map[sentence_id]]
-            if self.concat_all:
-                lan_id = 0
-            for i in range(sentence_length):
-                pos_id = batch_pos[s][i]
-                if i > 0:
-                    decision_scores[s, i, :, :, :] = np.log(self.decision_param[pos_id, :, :, :, lan_id])
-                else:
-                    decision_scores[s, i, :, :, :] = 0
-                for j in range(sentence_length):
-                    h_pos_id = batch_pos[s][i]
-                    m_pos_id = batch_pos[s][j]
-                    if j == 0:
-                        continue
-                    if i == j:
-                        continue
-                    if i > j:
-                        dir = 0
-                    else:
-                        dir = 1
-                    if eval_trans_param is None:
-                        if self.initial_flag or not self.sentence_predict or not self.training:
-                            scores[s, i, j, :] = np.log(self.trans_param[h_pos_id, m_pos_id, dir, :, lan_id])
-                        else:
-                            scores[s, i, j, :] = np.log(
-                                self.sentence_trans_param[sentence_id, h_pos_id, m_pos_id, dir, :])
-                    else:
-                         scores[s, i, j, :] = np.log(eval_trans_param[sentence_id, h_pos_id, m_pos_id, dir, :])
+        batch_sen = np.asarray(batch_sen)
+        if self.concat_all:
+            batch_lan = np.zeros(batch_size, dtype=int)
+        else:
+            batch_lan = np.array([languages[language_map[sentence_id]] for sentence_id in batch_sen], dtype=int)
+        # gather parameters of all (head, child) pairs at once; dir is 0 for children left of their head
+        h_pos_id = batch_pos[:, :, np.newaxis]
+        m_pos_id = batch_pos[:, np.newaxis, :]
+        position = np.arange(sentence_length)
+        dir = (position[np.newaxis, :] > position[:, np.newaxis]).astype(int)
+        # batch,head,child,valency
+        if eval_trans_param is None:
+            if self.initial_flag or not self.sentence_predict or not self.training:
+                log_trans_param = self.log_param('trans_param')
+                scores = log_trans_param[h_pos_id, m_pos_id, dir, :, batch_lan[:, np.newaxis, np.newaxis]]
+            else:
+                log_trans_param = self.log_param('sentence_trans_param')
+                scores = log_trans_param[batch_sen[:, np.newaxis, np.newaxis], h_pos_id, m_pos_id, dir, :]
+        else:
+            scores = np.log(eval_trans_param[batch_sen[:, np.newaxis, np.newaxis], h_pos_id, m_pos_id, dir, :])
+        scores[:, :, 0] = -np.inf
+        scores[:, position, position] = -np.inf
+        # batch,position,direction,valency,decision
+        decision_scores = self.log_param('decision_param')[batch_pos, :, :, :, batch_lan[:, np.newaxis]]
+        decision_scores[:, 0] = 0
 
         return scores, decision_scores  # scores: batch, h, c, v  ;decision_scores: batch, h d v stop
 
+    def log_param(self, name):
+        # log of a parameter table, computed once per parameter update
+        if 'log_' + name not in self.__dict__:
+            param = getattr(self, name)
+            log_param = utils.alloc_like(param, self.shared_param, self.memmap_dir, 'log_' + name)
+            if isinstance(param, utils.sentence_param):
+                np.log(param.values, out=log_param.values)
+            else:
+                np.log(param, out=log_param)
+            self.__dict__['log_' + name] = log_param
+        return self.__dict__['log_' + name]
+
     def update_counter(self, best_parse, trans_counter, decision_counter, lex_counter, batch_pos, batch_words):
         batch_likelihood = 0.0
         for sen_id in range(len(batch_pos)):
@@ -333,86 +391,96 @@ class ml_dmv_model(nn.Module):
         self.decision_param = old_div(decision_counter, decision_sum)
         return
 
-    def update_pseudo_count(self, inside_incomplete_table, inside_complete_table, sentence_prob,
-                            outside_incomplete_table, outside_complete_table, trans_counter,
-                            decision_counter, batch_pos, batch_sen, batch_lan):
-        batch_likelihood = 0.0
-        en_like = 0.0
+    def expected_count(self, inside_incomplete_table, inside_complete_table, sentence_prob,
+                       outside_incomplete_table, outside_complete_table, sentence_length):
+        # Pseudo counts for dependency arcs (batch, head, child, valence) and for STOP decisions
+        # (batch, position, direction, valence) from the inside-outside tables
+        batch_size = len(sentence_prob)
+        index = utils.get_span_index(sentence_length)
+        # Incomplete span of each arc, unused entries point to span 0
+        position = np.arange(sentence_length)
+        h, m = position[:, np.newaxis], position[np.newaxis, :]
+        arc_span_id = np.where((h != m) & (m > 0), index.span_id(np.minimum(h, m), np.maximum(h, m), (h < m) * 1), 0)
+        stop_span_id = index.span_id(position[:, np.newaxis], position[:, np.newaxis], np.arange(2))
+        arc_count = np.exp(inside_incomplete_table[:, arc_span_id] + outside_incomplete_table[:, arc_span_id]
+                           - sentence_prob.reshape(batch_size, 1, 1, 1, 1, 1))
+        stop_count = np.exp(inside_complete_table[:, stop_span_id] + outside_complete_table[:, stop_span_id]
+                            - sentence_prob.reshape(batch_size, 1, 1, 1, 1))
+        arc_count = arc_count.reshape(batch_size, sentence_length, sentence_length, self.dvalency)
+        stop_count = stop_count.reshape(batch_size, sentence_length, 2, self.dvalency)
+        return arc_count, stop_count
+
+    def update_pseudo_count(self, arc_count, stop_count, sentence_prob, trans_counter, decision_counter, batch_pos,
+                            batch_sen, batch_lan, batch_len=None):
         batch_size, sentence_length = batch_pos.shape
-        span_2_id, id_2_span, ijss, ikcs, ikis, kjcs, kjis, basic_span = utils.constituent_index(sentence_length, False)
-        for s in range(batch_size):
-            pos_sentence = batch_pos[s]
-            sentence_id = batch_sen[s]
-            lan_id = batch_lan[s]
-            one_sentence_count = []
-            one_sentence_decision_count = []
-            for h in range(sentence_length):
-                for m in range(sentence_length):
-                    if m == 0:
-                        continue
-                    if h == m:
-                        continue
-                    if h > m:
-                        dir = 0
-                    else:
-                        dir = 1
-                    h_pos = pos_sentence[h]
-                    m_pos = pos_sentence[m]
-                    if dir == 0:
-                        span_id = span_2_id[(m, h, dir)]
-                    else:
-                        span_id = span_2_id[(h, m, dir)]
-                    # Pseudo count for one dependency arc
-                    dep_count = inside_incomplete_table[s, span_id, :, :, :] + \
-                                outside_incomplete_table[s, span_id, :, :, :] - sentence_prob[s]
-                    if dir == 0:
-                        dep_count = dep_count.swapaxes(1, 0)
-                    if self.cvalency == 1:
-                        trans_counter[h_pos, m_pos, dir, 0, lan_id] += np.sum(np.exp(dep_count))
-                    else:
-                        trans_counter[h_pos, m_pos, dir, :, lan_id] += np.exp(dep_count).reshape(self.dvalency)
-                    # Add training samples for neural network
-                    if self.use_neural:
-                        for v in range(self.cvalency):
-                            count = np.exp(dep_count).reshape(self.dvalency)[v]
-                            self.rule_samples.append(list([h_pos, m_pos, dir, v, sentence_id, lan_id, count]))
-                    if h > 0:
-                        # Add count for CONTINUE decision
-                        decision_counter[h_pos, dir, :, 1, lan_id] += np.exp(dep_count).reshape(self.dvalency)
-                        if self.use_neural:
-                            reshaped_count = np.exp(dep_count).reshape(self.dvalency)
-                            for v in range(self.dvalency):
-                                count = reshaped_count[v]
-                                self.decision_samples.append(list([h_pos, dir, v, sentence_id, lan_id, 1, count]))
-            for m in range(1, sentence_length):
-                m_pos = pos_sentence[m]
-                for d in range(2):
-                    m_span_id = span_2_id[(m, m, d)]
-                    # Pseudo count for STOP decision
-                    stop_count = inside_complete_table[s, m_span_id, :, :] + \
-                                 outside_complete_table[s, m_span_id, :, :] - sentence_prob[s]
-                    decision_counter[m_pos, d, :, 0, lan_id] += np.exp(stop_count).reshape(self.dvalency)
-                    if self.use_neural:
-                        for v in range(self.dvalency):
-                            count = np.exp(stop_count).reshape(self.dvalency)[v]
-                            self.decision_samples.append(list([m_pos, d, v, sentence_id, lan_id, 0, count]))
-            batch_likelihood += sentence_prob[s]
-            if self.language_map[sentence_id] == 'en':
-                en_like += sentence_prob[s]
-            if self.sentence_predict:
-                self.sentence_counter[sentence_id] = one_sentence_count
-                self.sentence_decision_counter[sentence_id] = one_sentence_decision_count
+        batch_sen = np.asarray(batch_sen)
+        batch_lan = np.asarray(batch_lan)
+        position = np.arange(sentence_length)
+        if batch_len is None:
+            batch_len = np.full(batch_size, sentence_length)
+        # positions from the length of a sentence on are padding; the head of a padded sentence is counted as a child
+        # of the root rather than of the first padding token
+        padded = np.flatnonzero(batch_len < sentence_length)
+        arc_count[padded, 0] = arc_count[padded, batch_len[padded]]
+        is_word = position[np.newaxis, :] < batch_len[:, np.newaxis]
+        # all arcs between the words of each sentence in (sentence, head, child) order; root can not be taken as child
+        arc_s, arc_h, arc_m = np.nonzero(is_word[:, :, np.newaxis] & is_word[:, np.newaxis, :]
+                                         & (position[np.newaxis, :] > 0) & (position[:, np.newaxis] != position))
+        arc_dir = (arc_h < arc_m).astype(int)
+        h_pos = batch_pos[arc_s, arc_h]
+        m_pos = batch_pos[arc_s, arc_m]
+        arc_lan = batch_lan[arc_s]
+        # Pseudo count for dependency arcs, (arc, valence)
+        dep_count = arc_count[arc_s, arc_h, arc_m]
+        if self.cvalency == 1:
+            np.add.at(trans_counter[:, :, :, 0], (h_pos, m_pos, arc_dir, arc_lan), np.sum(dep_count, axis=1))
+        else:
+            np.add.at(trans_counter, (h_pos, m_pos, arc_dir, slice(None), arc_lan), dep_count)
+        # Add count for CONTINUE decision
+        continue_arc = arc_h > 0
+        np.add.at(decision_counter[:, :, :, 1], (h_pos[continue_arc], arc_dir[continue_arc], slice(None),
+                                                 arc_lan[continue_arc]), dep_count[continue_arc])
+        # Pseudo count for STOP decision of every word, (word, direction, valence)
+        stop_s, stop_m = np.nonzero(is_word & (position > 0))
+        stop_pos = batch_pos[stop_s, stop_m]
+        stop_lan = batch_lan[stop_s]
+        m_stop_count = stop_count[stop_s, stop_m]
+        np.add.at(decision_counter[:, :, :, 0], (stop_pos[:, np.newaxis], np.arange(2), slice(None),
+                                                 stop_lan[:, np.newaxis]), m_stop_count)
+        # Add training samples for neural network, ordered by sentence as the counts were collected
+        if self.use_neural:
+            valence = np.arange(self.cvalency)
+            self.rule_samples.append(h_pos[:, np.newaxis], m_pos[:, np.newaxis], arc_dir[:, np.newaxis], valence,
+                                     batch_sen[arc_s, np.newaxis], arc_lan[:, np.newaxis],
+                                     dep_count[:, :self.cvalency])
+            # CONTINUE and STOP samples of one sentence are kept together
+            valence = np.arange(self.dvalency)
+            continue_samples = np.broadcast_arrays(h_pos[continue_arc, np.newaxis], arc_dir[continue_arc, np.newaxis],
+                                                   valence, batch_sen[arc_s[continue_arc], np.newaxis],
+                                                   arc_lan[continue_arc, np.newaxis], 1, dep_count[continue_arc])
+            stop_samples = np.broadcast_arrays(stop_pos[:, np.newaxis, np.newaxis], np.arange(2)[:, np.newaxis],
+                                               valence, batch_sen[stop_s, np.newaxis, np.newaxis],
+                                               stop_lan[:, np.newaxis, np.newaxis], 0, m_stop_count)
+            sample_order = np.argsort(np.concatenate((np.repeat(arc_s[continue_arc], self.dvalency),
+                                                      np.repeat(stop_s, 2 * self.dvalency))), kind='stable')
+            self.decision_samples.append(*[np.concatenate((c.ravel(), s.ravel()))[sample_order]
+                                           for c, s in zip(continue_samples, stop_samples)])
+        batch_likelihood = np.sum(sentence_prob)
+        # batch_lan holds the id in self.languages of each sentence's language
+        en_like = np.sum(sentence_prob[batch_lan == self.languages['en']]) if 'en' in self.languages else 0.0
         return batch_likelihood, en_like
 
-    def find_predict_samples(self, batch_pos, batch_lan, batch_sen):
+    def find_predict_samples(self, batch_pos, batch_lan, batch_sen, batch_len=None):
         batch_size, sentence_length = batch_pos.shape
+        if batch_len is None:
+            batch_len = np.full(batch_size, sentence_length)
         predict_rule_samples = []
         rule_involved = set()
         for s in range(batch_size):
             pos_sentence = batch_pos[s]
             lan_id = batch_lan[s]
             sentence_id = batch_sen[s]
-            for h in range(sentence_length):
+            for h in range(batch_len[s]):
                 for dir in range(2):
                     if h == 0 and dir == 0:
                         continue
@@ -447,24 +515,65 @@ class ml_dmv_model(nn.Module):
         batch_decision_scores = batch_decision_scores + decision_mask
         return batch_scores, batch_decision_scores
 
-    def function_to_mask(self, batch_score, batch_pos):
+    def function_to_mask(self, batch_score, batch_pos, batch_len=None):
         batch_size, sentence_length, _, _ = batch_score.shape
-        function_score_mask = np.zeros(
-            (batch_size, sentence_length, sentence_length, self.cvalency))
-        for s in range(batch_size):
-
-            function_count = 0
-            for i in range(sentence_length):
-                pos_id = batch_pos[s, i]
-                pos = self.id_to_pos[pos_id]
-                if pos in self.function_set:
-                    function_score_mask[s, i, :, :] = -np.inf
-                    function_count += 1
-            if function_count == sentence_length - 1:
-                function_score_mask[s, :, :, :] = 1e-30
+        if batch_len is None:
+            batch_len = np.full(batch_size, sentence_length)
+        # function words can not be heads, unless all words of the sentence are function words
+        function_ids = [pos_id for pos_id, pos in self.id_to_pos.items() if pos in self.function_set]
+        is_function = np.isin(batch_pos, function_ids) & (np.arange(sentence_length) < batch_len[:, np.newaxis])
+        function_score_mask = np.zeros((batch_size, sentence_length, sentence_length, self.cvalency))
+        function_score_mask[is_function] = -np.inf
+        function_score_mask[np.count_nonzero(is_function, axis=1) == batch_len - 1] = 1e-30
         batch_score = batch_score + function_score_mask
         return batch_score
 
+    def mask_padding(self, batch_score, batch_decision_score, batch_len):
+        # Positions from batch_len on are padding. The root takes only the last padding token as child, each padding
+        # token takes the one before it as left child, and the first padding token takes the head of the sentence
+        # with the scores of the root. Padding decisions are free except that the first padding token stops after one
+        # left child, so every sentence keeps its partition function and its parses map one to one to padded ones.
+        # The padded charts add the same scores in another order, so they agree with unpadded ones to rounding only:
+        # where two parses of a sentence score the same up to rounding, the padded Viterbi parse may be the other one.
+        # check_padding.py compares both on treebank sentences.
+        batch_size, sentence_length = batch_score.shape[:2]
+        padded = np.flatnonzero(batch_len < sentence_length)
+        if len(padded) == 0:
+            return
+        padded_len = batch_len[padded]
+        is_padding = np.arange(sentence_length) >= batch_len[:, np.newaxis]
+        root_score = batch_score[padded, 0]
+        batch_score[is_padding[:, :, np.newaxis] | is_padding[:, np.newaxis, :]] = -np.inf
+        batch_score[padded, 0] = -np.inf
+        batch_score[padded, padded_len] = np.where(is_padding[padded, :, np.newaxis], -np.inf, root_score)
+        batch_score[padded, 0, sentence_length - 1] = 0
+        chain_s, chain_m = np.nonzero(is_padding[:, :-1])
+        batch_score[chain_s, chain_m + 1, chain_m] = 0
+        batch_decision_score[is_padding] = 0
+        batch_decision_score[padded, padded_len, 0, 1:, 1] = -np.inf
+
+    def parse_batch(self, batch_score, batch_decision_score, batch_pos, batch_len):
+        # Viterbi heads and tags of every sentence of a padded batch, from the scores of evaluate_batch_score
+        if self.function_mask:
+            batch_score = self.function_to_mask(batch_score, batch_pos, batch_len)
+        self.mask_padding(batch_score, batch_decision_score, batch_len)
+        batch_score = np.expand_dims(batch_score, 3)
+        batch_score = np.expand_dims(batch_score, 4)
+        batch_decision_score = np.expand_dims(batch_decision_score, 2)
+        if self.eisner_backend == 'torch':
+            batch_parse = torch_eisner_for_dmv.batch_parse(torch.from_numpy(batch_score),
+                                                           torch.from_numpy(batch_decision_score), self.dvalency,
+                                                           self.cvalency)
+        else:
+            batch_parse = eisner_for_dmv.batch_parse(batch_score, batch_decision_score, self.dvalency, self.cvalency)
+        parse_results = []
+        for i in range(len(batch_pos)):
+            # words of a padded sentence attached to its first padding token are children of the root
+            sentence_length = batch_len[i]
+            heads = batch_parse[0][i][:sentence_length]
+            heads[heads >= sentence_length] = 0
+            parse_results.append((heads, batch_parse[1][i][:sentence_length]))
+        return parse_results
 
     def save(self, fn):
         tmp = fn + '.tmp'
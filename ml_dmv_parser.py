@@ -10,7 +10,7 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
-import eisner_for_dmv
+import parallel_estep
 import utils
 from ml_dmv_model import ml_dmv_model as MLDMV
 from ml_neural_m_step import m_step_model as MMODEL
@@ -24,6 +24,14 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("--train", dest="train", help="train file", metavar="FILE", default="data/ud_file")
     parser.add_option("--dev", dest="dev", help="dev file", metavar="FILE", default="data/ud_file")
+    parser.add_option("--corpus_cache", type="string", dest="corpus_cache", default=None,
+                      help="directory of the binary treebank cache, filled on first use")
+    parser.add_option("--read_workers", type="int", dest="read_workers", default=0,
+                      help="processes parsing treebank files in parallel, 0 parses them in the main process")
+    parser.add_option("--span_index_cache", type="string", dest="span_index_cache", default=None,
+                      help="directory of the precompiled chart span indexes, filled on first use")
+    parser.add_option("--max_span_length", type="int", dest="max_span_length", default=60,
+                      help="longest sentence, root included, whose span index is kept in the cache")
 
     parser.add_option("--batch", type="int", dest="batchsize", default=5000)
     parser.add_option("--sample_batch", type="int", dest="sample_batch_size", default=50000)
@@ -39,6 +47,19 @@ if __name__ == '__main__':
     parser.add_option("--dvalency", type="int", dest="d_valency", default=2)
     parser.add_option("--cvalency", type="int", dest="c_valency", default=1)
     parser.add_option("--em_type", type="string", dest="em_type", default='viterbi')
+    parser.add_option("--estep_engine", type="choice", dest="estep_engine", choices=['inside_outside', 'autograd'],
+                      default='inside_outside', help="compute expected counts by inside-outside or by autograd")
+    parser.add_option("--eisner_backend", type="choice", dest="eisner_backend", choices=['numpy', 'torch'],
+                      default='numpy', help="run inside, outside and parsing charts in numpy or torch")
+    parser.add_option("--num_threads", type="int", dest="num_threads", default=0,
+                      help="torch intra-op threads, 0 keeps the torch default")
+    parser.add_option("--estep_workers", type="int", dest="estep_workers", default=0,
+                      help="worker processes for the E-step, 0 runs it in the main process; workers are forked "
+                           "and run the numpy inside-outside engine only")
+    parser.add_option("--shared_param", action="store_true", dest="shared_param", default=False,
+                      help="keep parameters and counters in shared memory")
+    parser.add_option("--memmap_dir", type="string", dest="memmap_dir", default=None,
+                      help="with --shared_param, back shared arrays by files in this directory")
 
     parser.add_option("--count_smoothing", type="float", dest="count_smoothing", default=1e-8)
     parser.add_option("--param_smoothing", type="float", dest="param_smoothing", default=1e-8)
@@ -71,6 +92,10 @@ if __name__ == '__main__':
     parser.add_option("--pre_ouput_dim", type="int", dest="pre_output_dim", default=15)
     parser.add_option("--decision_pre_output_dim", type="int", dest="decision_pre_output_dim", default=5)
     parser.add_option("--neural_epoch", type="int", dest="neural_epoch", default=1)
+    parser.add_option("--fused_m_step", action="store_true", dest="fused_m_step", default=False,
+                      help="train child and decision networks in one forward/backward per batch")
+    parser.add_option("--bucket_batches", action="store_true", dest="bucket_batches", default=False,
+                      help="batch sentences of similar length together, padded to the longest one")
     parser.add_option("--unified_network", action="store_true", dest="unified_network", default=False)
     parser.add_option("--reset_weight", action="store_true", dest="reset_weight", default=False)
 
@@ -89,6 +114,9 @@ if __name__ == '__main__':
     parser.add_option("--language_predict",action="store_true",default=False)
 
     (options, args) = parser.parse_args()
+    if options.estep_workers > 0 and (options.estep_engine != 'inside_outside' or options.eisner_backend != 'numpy'):
+        parser.error('--estep_workers needs --estep_engine inside_outside and --eisner_backend numpy, forked '
+                     'workers can not run torch')
 
 
     def do_eval(dmv_model, m_model, pos, languages, language_map, epoch, options):
@@ -102,18 +130,23 @@ if __name__ == '__main__':
             eval_languages = {l: i for i, l in enumerate(eval_language_set)}
         eval_file_list = os.listdir(options.dev)
         eval_file_set = utils.get_file_set(eval_file_list, eval_language_set, False)
-        eval_sentences, eval_language_map = utils.read_multiple_data(options.dev, eval_file_set, True)
+        eval_sentences, eval_language_map = utils.read_multiple_data(options.dev, eval_file_set, True,
+                                                                     options.corpus_cache, options.read_workers)
         dmv_model.eval()
         if options.use_neural:
             m_model.eval()
         devpath = os.path.join(options.output, 'eval_pred' + str(epoch + 1) + '_' + str(options.sample_idx))
         eval_data_list, _, eval_sentence_map = utils.construct_ml_pos_data(eval_sentences, pos, eval_languages,
                                                                            eval_language_map)
-        eval_batch_data = utils.construct_batch_data(eval_data_list, options.batchsize)
+        if options.bucket_batches:
+            eval_batch_data = utils.construct_bucket_batch_data(eval_data_list, options.batchsize)
+        else:
+            eval_batch_data = utils.construct_batch_data(eval_data_list, options.batchsize)
         parse_results = {}
         classify_results = np.zeros(len(eval_data_list))
         if options.sentence_predict and epoch > options.non_neural_iter:
-            eval_trans_param = np.zeros((len(eval_data_list), len(list(pos.keys())), len(list(pos.keys())), 2, options.c_valency))
+            eval_trans_param = utils.sentence_param([d[0] for d in eval_data_list], len(list(pos.keys())),
+                                                    options.c_valency)
         else:
             eval_trans_param = None
         for batch_id, one_batch in enumerate(eval_batch_data):
@@ -121,9 +154,10 @@ if __name__ == '__main__':
                 s[2][0] for s in one_batch]
             eval_batch_sen = np.array(eval_batch_sen)
             eval_batch_lan = np.array(eval_batch_lan)
-            eval_batch_pos = np.array(eval_batch_pos)
+            eval_batch_pos, eval_batch_len = utils.pad_batch_pos(eval_batch_pos)
             if (options.sentence_predict and epoch > options.non_neural_iter) or options.language_predict:
-                batch_rule_samples = dmv_model.find_predict_samples(eval_batch_pos, eval_batch_lan, eval_batch_sen)
+                batch_rule_samples = dmv_model.find_predict_samples(eval_batch_pos, eval_batch_lan, eval_batch_sen,
+                                                                    eval_batch_len)
                 batch_predict_data = utils.construct_ml_predict_data(batch_rule_samples)
                 batch_predict_pos_v = torch.LongTensor(batch_predict_data['pos'])
                 batch_predict_pos_index = np.array(batch_predict_data['pos'])
@@ -133,15 +167,12 @@ if __name__ == '__main__':
                 batch_predict_cvalency_index = np.array(batch_predict_data['cvalency'])
                 batch_predict_lan_v = torch.LongTensor(batch_predict_data['languages'])
                 batch_predict_lan_index = np.array(batch_predict_data['languages'])
-                batch_predict_sen_v = []
-                for sentence_id in batch_predict_data['sentence']:
-                    batch_predict_sen_v.append(eval_sentence_map[sentence_id])
                 batch_predict_sen_index = np.array(batch_predict_data['sentence'])
-                batch_predict_sen_v = torch.LongTensor(batch_predict_sen_v)
+                batch_predict_sen_v = m_model.encode_sentences(batch_predict_sen_index, eval_sentence_map)
                 batch_predicted, batch_predicted_lan = m_model.forward_(batch_predict_pos_v, batch_predict_dir_v,
                                                                         batch_predict_cvalency_v, None, None, True,
-                                                                        'child',
-                                                                        batch_predict_lan_v, batch_predict_sen_v, None)
+                                                                        'child', batch_predict_lan_v, None, None,
+                                                                        batch_predict_sen_v)
                 if options.sentence_predict or options.language_predict:
                     # Evaluation of language pediction
                     for i in range(len(batch_predict_sen_v)):
@@ -156,15 +187,9 @@ if __name__ == '__main__':
             batch_score, batch_decision_score = dmv_model.evaluate_batch_score(eval_batch_pos, eval_batch_sen,
                                                                                eval_language_map, eval_languages,
                                                                                eval_trans_param)
-            if options.function_mask:
-                batch_score = dmv_model.function_to_mask(batch_score, eval_batch_pos)
-            batch_score = np.expand_dims(batch_score, 3)
-            batch_score = np.expand_dims(batch_score, 4)
-            batch_decision_score = np.expand_dims(batch_decision_score, 2)
-            batch_parse = eisner_for_dmv.batch_parse(batch_score, batch_decision_score, dmv_model.dvalency,
-                                                     dmv_model.cvalency)
+            batch_parse = dmv_model.parse_batch(batch_score, batch_decision_score, eval_batch_pos, eval_batch_len)
             for i in range(len(eval_batch_pos)):
-                parse_results[eval_batch_sen[i]] = (batch_parse[0][i], batch_parse[1][i])
+                parse_results[eval_batch_sen[i]] = batch_parse[i]
         utils.eval_ml(parse_results, eval_sentences, devpath, options.log + '_dev' + str(options.sample_idx),
                       eval_language_map, eval_languages, epoch)
         # utils.write_distribution(dmv_model)
@@ -179,10 +204,16 @@ if __name__ == '__main__':
             print("Language classification accuracy " + str(correct_rate))
 
 
+    if options.num_threads > 0:
+        torch.set_num_threads(options.num_threads)
+
     if options.gpu >= 0 and torch.cuda.is_available():
         torch.cuda.set_device(options.gpu)
         print('To use gpu' + str(options.gpu))
 
+    if options.span_index_cache is not None:
+        utils.load_span_index_cache(options.span_index_cache, options.max_span_length)
+
     chosen_list = ['en', 'de', 'nl', 'it', 'fr', 'la_ittb', 'no', 'bg', 'sl', 'grc',
                    'eu', 'et', 'fi', 'hi', 'ja']
     #chosen_list = ['en','nl']
@@ -193,7 +224,8 @@ if __name__ == '__main__':
 
     file_list = os.listdir(options.train)
     file_set = utils.get_file_set(file_list, language_set, True)
-    pos, sentences, languages, language_map = utils.read_multiple_data(options.train, file_set, False)
+    pos, sentences, languages, language_map = utils.read_multiple_data(options.train, file_set, False,
+                                                                       options.corpus_cache, options.read_workers)
     sentence_language_map = {}
     if options.concat_all:
         languages = {'all': 0}
@@ -216,6 +248,7 @@ if __name__ == '__main__':
     ml_dmv_model.init_param(sentences)
 
     print('Parameters initialized')
+
     if options.gpu >= 0 and torch.cuda.is_available():
         torch.cuda.set_device(options.gpu)
         ml_dmv_model.cuda(options.gpu)
@@ -225,37 +258,54 @@ if __name__ == '__main__':
     else:
         m_model = None
 
+    if options.bucket_batches:
+        construct_sub_batch_data = utils.construct_bucket_batch_data
+    else:
+        construct_sub_batch_data = utils.construct_batch_data
+
     for epoch in range(options.epochs):
         print("\n")
         print("Training epoch " + str(epoch))
         ml_dmv_model.train()
         en_likehood = 0.0
         training_likelihood = 0.0
-        trans_counter = np.zeros(
-            (len(list(pos.keys())), len(list(pos.keys())), 2, options.c_valency, len(languages)))  # p c d v l
+        trans_counter = utils.alloc_array(
+            (len(list(pos.keys())), len(list(pos.keys())), 2, options.c_valency, len(languages)),
+            options.shared_param, options.memmap_dir, 'trans_counter')  # p c d v l
         # head_pos,head_tag,direction,decision_valence,decision,languages
-        decision_counter = np.zeros((len(list(pos.keys())), 2, options.d_valency, 2, len(languages)))  # p d v stop l
+        decision_counter = utils.alloc_array((len(list(pos.keys())), 2, options.d_valency, 2, len(languages)),
+                                             options.shared_param, options.memmap_dir,
+                                             'decision_counter')  # p d v stop l
         random.shuffle(batch_data)
         tot_batch = len(batch_data)
         if options.use_neural:
-            ml_dmv_model.rule_samples = []
-            ml_dmv_model.decision_samples = []
-
-        for batch_id, one_batch in tqdm(enumerate(batch_data), mininterval=2,
-                                        desc=' -Tot it %d (epoch %d)' % (tot_batch, 0), leave=False, file=sys.stdout):
-            batch_likelihood = 0.0
-            sub_batch_data = utils.construct_batch_data(one_batch, options.sub_batch_size)
-            # For each batch,put all sentences with the same length to one sub-batch
-            for one_sub_batch in sub_batch_data:
-                sub_batch_pos, sub_batch_lan, sub_batch_sen = [s[0] for s in one_sub_batch], \
-                                                              [s[1] for s in one_sub_batch], \
-                                                              [s[2][0] for s in one_sub_batch]
-                # E-step
-                sub_batch_likelihood, en_like = ml_dmv_model.em_e(sub_batch_pos, sub_batch_lan, sub_batch_sen,
-                                                                  trans_counter, decision_counter, ml_dmv_model.em_type)
-                en_likehood += en_like
-                batch_likelihood += sub_batch_likelihood
-            training_likelihood += batch_likelihood
+            ml_dmv_model.rule_samples = utils.sample_buffer(utils.RULE_SAMPLE_FIELDS)
+            ml_dmv_model.decision_samples = utils.sample_buffer(utils.DECISION_SAMPLE_FIELDS)
+
+        if options.estep_workers > 0:
+            # For each batch,put sentences of the same length (or of similar lengths) to one sub-batch
+            sub_batch_data = [one_sub_batch for one_batch in batch_data
+                              for one_sub_batch in construct_sub_batch_data(one_batch, options.sub_batch_size)]
+            training_likelihood, en_likehood = parallel_estep.em_e(ml_dmv_model, sub_batch_data, trans_counter,
+                                                                   decision_counter, options.estep_workers)
+        else:
+            for batch_id, one_batch in tqdm(enumerate(batch_data), mininterval=2,
+                                            desc=' -Tot it %d (epoch %d)' % (tot_batch, 0), leave=False,
+                                            file=sys.stdout):
+                batch_likelihood = 0.0
+                sub_batch_data = construct_sub_batch_data(one_batch, options.sub_batch_size)
+                # For each batch,put sentences of the same length (or of similar lengths) to one sub-batch
+                for one_sub_batch in sub_batch_data:
+                    sub_batch_pos, sub_batch_lan, sub_batch_sen = [s[0] for s in one_sub_batch], \
+                                                                  [s[1] for s in one_sub_batch], \
+                                                                  [s[2][0] for s in one_sub_batch]
+                    # E-step
+                    sub_batch_likelihood, en_like = ml_dmv_model.em_e(sub_batch_pos, sub_batch_lan, sub_batch_sen,
+                                                                      trans_counter, decision_counter,
+                                                                      ml_dmv_model.em_type)
+                    en_likehood += en_like
+                    batch_likelihood += sub_batch_likelihood
+                training_likelihood += batch_likelihood
         if epoch > options.non_neural_iter:
             ml_dmv_model.initial_flag = False
         print('Likelihood for this iteration', training_likelihood)
@@ -25,6 +25,7 @@ class m_step_model(nn.Module):
         self.drop_out = options.drop_out
         self.child_only = options.child_only
         self.neural_epoch = options.neural_epoch
+        self.fused_m_step = options.fused_m_step
         self.gpu = options.gpu
         self.pembedding_dim = options.pembedding_dim
         self.valency_dim = options.valency_dim
@@ -112,13 +113,17 @@ class m_step_model(nn.Module):
             lan_loss = None
         return lan_loss, lan_prediction
 
-    def get_sentence_v(self, sentences):
+    def get_sentence_v(self, sentences, sentences_len):
+        # sentences is a padded batch and sentences_len the lengths of its sentences. The LSTM runs on the packed
+        # batch and its outputs are averaged over the real tokens only
         if sentences is not None:
             embeds = self.head_lstm_embeddings(sentences)
-            lstm_out, self.hidden = self.lstm(embeds)
+            packed_embeds = pack_padded_sequence(embeds, sentences_len, batch_first=True, enforce_sorted=False)
+            lstm_out, self.hidden = self.lstm(packed_embeds)
+            lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True, total_length=sentences.size(1))
             # sentences_lstm = torch.transpose(self.hidden[0], 0, 1)
             # sentences_lstm = sentences_lstm.contiguous().view(sentences_lstm.size()[0], -1)
-            sentences_lstm = torch.mean(lstm_out, dim=1)
+            sentences_lstm = torch.sum(lstm_out, dim=1) / sentences_len.unsqueeze(1).float()
             sentence_v = self.dropout_layer(sentences_lstm)
             sentence_v = self.sentence_mlp(sentence_v)
             sentence_v = F.relu(sentence_v)
@@ -126,8 +131,22 @@ class m_step_model(nn.Module):
             sentence_v = None
         return sentence_v
 
+    def encode_sentences(self, sentence_ids, sentence_map=None):
+        # Sentence vectors for sentence_ids of sentence_map (the training sentences by default). Each distinct sentence
+        # is encoded once, in padded batches, and without autograd outside training.
+        if sentence_map is None:
+            sentence_map = self.sentence_map
+        unique_ids, sentence_index = np.unique(sentence_ids, return_inverse=True)
+        sentence_v = []
+        for start in range(0, len(unique_ids), self.sample_batch_size):
+            batch = unique_ids[start:start + self.sample_batch_size]
+            batch_sentences, batch_len = utils.pad_sentences([sentence_map[s] for s in batch])
+            with torch.set_grad_enabled(self.training):
+                sentence_v.append(self.get_sentence_v(batch_sentences, batch_len))
+        return torch.cat(sentence_v)[torch.from_numpy(sentence_index)]
+
     def forward_(self, batch_pos, batch_dir, batch_valence, batch_target, batch_target_count,
-                 is_prediction, type, batch_lan_id, sentences, sentences_len):
+                 is_prediction, type, batch_lan_id, sentences, sentences_len, sentence_v=None):
         p_embeds = self.plookup(batch_pos)
         if type == 'child':
             v_embeds = self.vlookup(batch_valence)
@@ -141,7 +160,9 @@ class m_step_model(nn.Module):
             lan_embeds = self.llookup(batch_lan_id)
             input_embeds = torch.cat((input_embeds, lan_embeds), 1)
         if self.sentence_predict or self.language_predict:
-            sentence_v = self.get_sentence_v(sentences)
+            # sentence vectors may be given already encoded
+            if sentence_v is None:
+                sentence_v = self.get_sentence_v(sentences, sentences_len)
             if self.sentence_predict:
                 input_embeds = torch.cat((p_embeds, v_embeds, sentence_v), 1)
             if sentence_v is not None:
@@ -234,71 +255,51 @@ class m_step_model(nn.Module):
         else:
             input_pos_num, target_pos_num, dir_num, cvalency, lan_num = trans_param.shape
         input_decision_pos_num, decision_dir_num, dvalency, target_decision_num, lan_num = decision_param.shape
-        input_trans_list = [[p, d, cv, l] for p in range(input_pos_num) for d in range(dir_num) for cv in
-                            range(cvalency) for l in range(lan_num)]
-        input_decision_list = [[p, d, dv, l] for p in range(input_decision_pos_num) for d in range(dir_num) for dv in
-                               range(dvalency) for l in range(lan_num)]
-
-        batched_input_trans = utils.construct_update_batch_data(input_trans_list, self.sample_batch_size)
-        batched_input_decision = utils.construct_update_batch_data(input_decision_list, self.sample_batch_size)
-        trans_batch_num = len(batched_input_trans)
-        decision_batch_num = len(batched_input_decision)
         if self.sentence_predict:
-            for s in range(len(self.sentence_map)):
-                for i in range(trans_batch_num):
-                    # Update transition parameters
-                    one_batch_size = len(batched_input_trans[i])
-                    batch_target_lan_v = torch.LongTensor([self.languages[self.language_map[s]]]).expand(
-                        one_batch_size)
-                    batch_input_len = torch.LongTensor([len(self.sentence_map[s])]).expand(one_batch_size)
-                    batch_input_sen_v = torch.LongTensor([self.sentence_map[s]]).expand(one_batch_size,
-                                                                                        len(self.sentence_map[s]))
-                    one_batch_input_pos = torch.LongTensor(batched_input_trans[i])[:, 0]
-                    one_batch_dir = torch.LongTensor(batched_input_trans[i])[:, 1]
-                    one_batch_cvalency = torch.LongTensor(batched_input_trans[i])[:, 2]
+            # Encode every sentence once, then predict the rows of all (sentence, head POS, dir, valence) in large
+            # batches; only head POS of a sentence have parameters
+            with torch.no_grad():
+                sentence_v = self.encode_sentences(list(range(len(self.sentence_map))))
+                sentence_head = np.argwhere(trans_param.row_index >= 0)
+                predict_input = np.array([[s, p, d, cv] for s, p in sentence_head for d in range(dir_num)
+                                          for cv in range(cvalency)]).reshape(-1, 4)
+                sentence_lan = np.array([self.languages[self.language_map[s]] for s in range(len(self.sentence_map))])
+                for start in range(0, len(predict_input), self.sample_batch_size):
+                    one_batch_input = predict_input[start:start + self.sample_batch_size]
+                    one_batch_sentence_index = one_batch_input[:, 0]
                     # Parameter index for update
-                    one_batch_input_pos_index = np.array(batched_input_trans[i])[:, 0]
-                    one_batch_dir_index = np.array(batched_input_trans[i])[:, 1]
-                    one_batch_cvalency_index = np.array(batched_input_trans[i])[:, 2]
-                    predicted_trans_param, _ = self.forward_(one_batch_input_pos, one_batch_dir, one_batch_cvalency,
-                                                             None, None, True, 'child', batch_target_lan_v,
-                                                             batch_input_sen_v, batch_input_len)
-                    trans_param[s][one_batch_input_pos_index, :, one_batch_dir_index,
-                    one_batch_cvalency_index] = predicted_trans_param.detach().numpy()
+                    one_batch_input_pos_index = one_batch_input[:, 1]
+                    one_batch_dir_index = one_batch_input[:, 2]
+                    one_batch_cvalency_index = one_batch_input[:, 3]
+                    predicted_trans_param, _ = self.forward_(torch.LongTensor(one_batch_input_pos_index),
+                                                             torch.LongTensor(one_batch_dir_index),
+                                                             torch.LongTensor(one_batch_cvalency_index), None, None,
+                                                             True, 'child',
+                                                             torch.LongTensor(sentence_lan[one_batch_sentence_index]),
+                                                             None, None, sentence_v[one_batch_sentence_index])
+                    trans_param[one_batch_sentence_index, one_batch_input_pos_index, :, one_batch_dir_index,
+                                one_batch_cvalency_index] = predicted_trans_param.numpy()
         else:
-            for i in range(trans_batch_num):
-                one_batch_size = len(batched_input_trans[i])
-                one_batch_input_pos = torch.LongTensor(batched_input_trans[i])[:, 0]
-                one_batch_dir = torch.LongTensor(batched_input_trans[i])[:, 1]
-                one_batch_cvalency = torch.LongTensor(batched_input_trans[i])[:, 2]
-                one_batch_lan = torch.LongTensor(batched_input_trans[i])[:, 3]
-                # Parameter index for update
-                one_batch_input_pos_index = np.array(batched_input_trans[i])[:, 0]
-                one_batch_dir_index = np.array(batched_input_trans[i])[:, 1]
-                one_batch_cvalency_index = np.array(batched_input_trans[i])[:, 2]
-                one_batch_lan_index = np.array(batched_input_trans[i])[:, 3]
-                predicted_trans_param, _ = self.forward_(one_batch_input_pos, one_batch_dir, one_batch_cvalency,
-                                                         None, None, True, 'child', one_batch_lan, None, None)
-                trans_param[one_batch_input_pos_index, :, one_batch_dir_index, one_batch_cvalency_index,
-                one_batch_lan_index] = predicted_trans_param.detach().numpy()
+            # The whole table is small: predict every (head POS, dir, valence, language) in one forward and reshape
+            # the child distributions into place
+            with torch.no_grad():
+                input_pos, input_dir, input_cvalency, input_lan = utils.index_grid(
+                    (input_pos_num, dir_num, cvalency, lan_num))
+                predicted_trans_param, _ = self.forward_(input_pos, input_dir, input_cvalency, None, None, True,
+                                                         'child', input_lan, None, None)
+            predicted_trans_param = predicted_trans_param.numpy().reshape(input_pos_num, dir_num, cvalency, lan_num,
+                                                                          target_pos_num)
+            trans_param[...] = np.moveaxis(predicted_trans_param, 4, 1)
 
         if not child_only:
-            for i in range(decision_batch_num):
-                # Update decision parameters
-                one_batch_input_decision_pos = torch.LongTensor(np.array(batched_input_decision[i])[:, 0])
-                one_batch_decision_dir = torch.LongTensor(batched_input_decision[i])[:, 1]
-                one_batch_dvalency = torch.LongTensor(batched_input_decision[i])[:, 2]
-                one_batch_decision_lan = torch.LongTensor(batched_input_decision[i])[:, 3]
-                # Decision parameter index for update
-                one_batch_input_decision_pos_index = np.array(batched_input_decision[i])[:, 0]
-                one_batch_decision_dir_index = np.array(batched_input_decision[i])[:, 1]
-                one_batch_dvalency_index = np.array(batched_input_decision[i])[:, 2]
-                one_batch_decision_lan_index = np.array(batched_input_decision[i])[:, 3]
-                predicted_decision_param, _ = self.forward_(one_batch_input_decision_pos, one_batch_decision_dir,
-                                                            one_batch_dvalency, None, None, True, 'decision',
-                                                            one_batch_decision_lan, None, None)
-                decision_param[one_batch_input_decision_pos_index, one_batch_decision_dir_index,
-                one_batch_dvalency_index, :, one_batch_decision_lan_index] = predicted_decision_param.detach().numpy()
+            with torch.no_grad():
+                input_pos, input_dir, input_dvalency, input_lan = utils.index_grid(
+                    (input_decision_pos_num, decision_dir_num, dvalency, lan_num))
+                predicted_decision_param, _ = self.forward_(input_pos, input_dir, input_dvalency, None, None, True,
+                                                            'decision', input_lan, None, None)
+            predicted_decision_param = predicted_decision_param.numpy().reshape(
+                input_decision_pos_num, decision_dir_num, dvalency, lan_num, target_decision_num)
+            decision_param[...] = np.moveaxis(predicted_decision_param, 4, 3)
         else:
             decision_counter = decision_counter + self.param_smoothing
             decision_sum = np.sum(decision_counter, axis=3, keepdims=True)
@@ -308,13 +309,20 @@ class m_step_model(nn.Module):
     def batch_training(self, rule_samples, decision_samples, data_pos):
         self.train()
         self.param_predict = False
+        if self.em_type == 'em' and not (self.sentence_predict or self.language_predict):
+            # Without sentence features, samples that only differ in their sentence are one training example whose
+            # count is the sum of theirs; the count-weighted loss stays the same
+            rule_samples = rule_samples.aggregate(['head_pos', 'child_pos', 'dir', 'cvalency', 'language'])
+            decision_samples = decision_samples.aggregate(['pos', 'dir', 'dvalency', 'language', 'decision'])
+        if self.fused_m_step:
+            self.fused_batch_training(rule_samples, decision_samples, data_pos)
+            return
         for e in range(self.neural_epoch):
             iter_loss = 0.0
             iter_lang_loss = 0.0
             # Put training samples in batches
             batch_input_data, batch_target_data, batch_decision_data, batch_decision_target_data = \
-                utils.construct_ml_input_data(rule_samples, decision_samples, self.sentence_map, self.sample_batch_size,
-                                              self.em_type)
+                utils.construct_ml_input_data(rule_samples, decision_samples, self.sample_batch_size, self.em_type)
             # print 'batch_data for training constructed'
             batch_num = len(batch_input_data['input_pos'])
             tot_batch = batch_num
@@ -328,11 +336,8 @@ class m_step_model(nn.Module):
                 batch_cvalency_v = torch.LongTensor(batch_input_data['cvalency'][batch_id])
                 # Input tensor for sentences
                 if self.sentence_predict or self.language_predict:
-                    batch_input_sen_v = []
-                    for sentence_id in batch_input_data['sentence'][batch_id]:
-                        batch_input_sen_v.append(data_pos[int(sentence_id)])
-                    batch_input_sen_v = torch.LongTensor(batch_input_sen_v)
-                    batch_input_len = len(batch_input_sen_v[0])
+                    batch_input_sen_v, batch_input_len = utils.pad_sentences(
+                        [data_pos[int(sentence_id)] for sentence_id in batch_input_data['sentence'][batch_id]])
                 else:
                     batch_input_sen_v = None
                     batch_input_len = None
@@ -376,11 +381,9 @@ class m_step_model(nn.Module):
                     else:
                         batch_target_decision_count_v = None
                     if self.sentence_predict:
-                        batch_decision_sen_v = []
-                        for sentence_id in batch_decision_data['sentence'][decision_batch_id]:
-                            batch_decision_sen_v.append(data_pos[int(sentence_id)])
-                        batch_decision_sen_v = torch.LongTensor(batch_decision_sen_v)
-                        batch_decision_len = len(batch_decision_sen_v[0])
+                        batch_decision_sen_v, batch_decision_len = utils.pad_sentences(
+                            [data_pos[int(sentence_id)] for sentence_id in
+                             batch_decision_data['decision_sentence'][decision_batch_id]])
                     else:
                         batch_decision_sen_v = None
                         batch_decision_len = None
@@ -395,3 +398,79 @@ class m_step_model(nn.Module):
                     self.optim.zero_grad()
                 print("decision loss for this iteration is " + str(
                     old_div(iter_decision_loss.detach().data.numpy(), batch_num)))
+
+    def fused_batch_training(self, rule_samples, decision_samples, data_pos):
+        # Child and decision samples are cut into the same number of batches and every step trains both networks in
+        # one forward/backward. Input tensors are built once, batches index into them. Sentences of a batch are
+        # encoded once for its child and decision samples.
+        use_sentence = self.sentence_predict or self.language_predict
+        train_decision = not self.child_only
+        rule_v = utils.sample_tensors(rule_samples)
+        decision_v = utils.sample_tensors(decision_samples) if train_decision else None
+        if use_sentence:
+            sentence_ids = [rule_samples.column('sentence')]
+            if train_decision:
+                sentence_ids.append(decision_samples.column('sentence'))
+            sentence_ids, sample_sentence = np.unique(np.concatenate(sentence_ids), return_inverse=True)
+            rule_sentence = sample_sentence[:len(rule_samples)]
+            decision_sentence = sample_sentence[len(rule_samples):]
+            sentence_table, sentence_len = utils.pad_sentences([data_pos[int(s)] for s in sentence_ids])
+        batch_num = -(-len(rule_samples) // self.sample_batch_size)
+        if train_decision:
+            batch_num = max(batch_num, -(-len(decision_samples) // self.sample_batch_size))
+        # samples are stored sentence by sentence, so the k-th child and decision batches cover about the same
+        # sentences and a batch has few sentences to encode
+        rule_batches = np.array_split(np.arange(len(rule_samples)), batch_num)
+        if train_decision:
+            decision_batches = np.array_split(np.arange(len(decision_samples)), batch_num)
+        for e in range(self.neural_epoch):
+            iter_loss = 0.0
+            iter_lang_loss = 0.0
+            iter_decision_loss = 0.0
+            for batch_id in tqdm(np.random.permutation(batch_num), mininterval=2,
+                                 desc=' -Tot it %d (epoch %d)' % (batch_num, 0), leave=False, file=sys.stdout):
+                rule_batch = torch.from_numpy(rule_batches[batch_id])
+                rule_count_v = rule_v['count'][rule_batch] if self.em_type == 'em' else None
+                if train_decision:
+                    decision_batch = torch.from_numpy(decision_batches[batch_id])
+                    decision_count_v = decision_v['count'][decision_batch] if self.em_type == 'em' else None
+                rule_sentence_v = decision_sentence_v = None
+                if use_sentence:
+                    batch_sentence_index = [rule_sentence[rule_batches[batch_id]]]
+                    if train_decision:
+                        batch_sentence_index.append(decision_sentence[decision_batches[batch_id]])
+                    batch_sentences, batch_sample_sentence = np.unique(np.concatenate(batch_sentence_index),
+                                                                       return_inverse=True)
+                    batch_sentences = torch.from_numpy(batch_sentences)
+                    batch_sample_sentence = torch.from_numpy(batch_sample_sentence)
+                    batch_sentence_len = sentence_len[batch_sentences]
+                    sentence_v = self.get_sentence_v(
+                        sentence_table[batch_sentences, :int(batch_sentence_len.max())], batch_sentence_len)
+                    rule_sentence_v = torch.index_select(sentence_v, 0, batch_sample_sentence[:len(rule_batch)])
+                    if self.sentence_predict and train_decision:
+                        decision_sentence_v = torch.index_select(sentence_v, 0,
+                                                                  batch_sample_sentence[len(rule_batch):])
+                batch_loss, lang_loss = self.forward_(
+                    rule_v['head_pos'][rule_batch], rule_v['dir'][rule_batch], rule_v['cvalency'][rule_batch],
+                    rule_v['child_pos'][rule_batch], rule_count_v, False,
+                    'child', rule_v['language'][rule_batch], None, None, rule_sentence_v)
+                iter_loss += batch_loss.detach()
+                iter_lang_loss += lang_loss.detach()
+                total_loss = batch_loss
+                if train_decision:
+                    batch_decision_loss, _ = self.forward_(
+                        decision_v['pos'][decision_batch], decision_v['dir'][decision_batch],
+                        decision_v['dvalency'][decision_batch], decision_v['decision'][decision_batch],
+                        decision_count_v, False, 'decision',
+                        decision_v['language'][decision_batch], None, None, decision_sentence_v)
+                    iter_decision_loss += batch_decision_loss.detach()
+                    total_loss = total_loss + batch_decision_loss
+                total_loss.backward()
+                self.optim.step()
+                self.optim.zero_grad()
+            print("child loss for this iteration is " + str(old_div(iter_loss.detach().data.numpy(), batch_num)))
+            if use_sentence:
+                print("language loss for this iteration is " + str(old_div(iter_lang_loss.detach().data.numpy(), batch_num)))
+            if train_decision:
+                print("decision loss for this iteration is " + str(
+                    old_div(iter_decision_loss.detach().data.numpy(), batch_num)))
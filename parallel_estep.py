@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+import utils
+
+# E-step over worker processes. Workers are forked once per epoch, after the M-step, so they read the current DMV
+# parameters from the parent's memory without pickling them. Every sub-batch returns its own counters, likelihoods
+# and neural training samples, which are summed in the parent in sub-batch order. With shared parameters, each
+# worker instead adds its counts to its own shard of shared counter arrays, and the parent sums the shards.
+#
+# By then the parent has run torch, whose OpenMP thread pool does not survive a fork: a forked child that runs torch
+# operations can hang. Workers therefore only run the numpy E-step, the autograd engine and the torch chart backend
+# are refused.
+
+_estep_model = None
+_estep_counter_shapes = None
+_estep_counter_shards = None
+_worker_shard = None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def _init_worker(shard_owners):
+    # Claim a counter shard that no live worker owns. A worker that replaces one which exited takes over its shard
+    # and keeps adding to the counts already there; the pool reaps exited workers before starting new ones.
+    global _worker_shard
+    with shard_owners.get_lock():
+        for shard, owner in enumerate(shard_owners):
+            if owner == 0 or not _pid_alive(owner):
+                shard_owners[shard] = os.getpid()
+                _worker_shard = shard
+                return
+    raise RuntimeError('no free E-step counter shard')
+
+
+def _run_sub_batch(sub_batch):
+    dmv_model = _estep_model
+    sub_batch_pos, sub_batch_lan, sub_batch_sen = [s[0] for s in sub_batch], [s[1] for s in sub_batch], \
+                                                  [s[2][0] for s in sub_batch]
+    if _estep_counter_shards is None:
+        trans_counter = np.zeros(_estep_counter_shapes[0])
+        decision_counter = np.zeros(_estep_counter_shapes[1])
+    else:
+        trans_counter = _estep_counter_shards[0][_worker_shard]
+        decision_counter = _estep_counter_shards[1][_worker_shard]
+    if dmv_model.use_neural:
+        dmv_model.rule_samples = utils.sample_buffer(utils.RULE_SAMPLE_FIELDS)
+        dmv_model.decision_samples = utils.sample_buffer(utils.DECISION_SAMPLE_FIELDS)
+    sub_batch_likelihood, en_like = dmv_model.em_e(sub_batch_pos, sub_batch_lan, sub_batch_sen, trans_counter,
+                                                   decision_counter, dmv_model.em_type)
+    if dmv_model.use_neural:
+        samples = (dmv_model.rule_samples, dmv_model.decision_samples)
+    else:
+        samples = None
+    if _estep_counter_shards is not None:
+        trans_counter = decision_counter = None
+    return sub_batch_likelihood, en_like, trans_counter, decision_counter, samples
+
+
+def em_e(dmv_model, sub_batch_data, trans_counter, decision_counter, workers):
+    # Run the E-step of all sub-batches on a pool of workers, adding to trans_counter and decision_counter and to
+    # the sample buffers of dmv_model. Returns the likelihood and the English likelihood of all sentences.
+    global _estep_model, _estep_counter_shapes, _estep_counter_shards
+    if dmv_model.estep_engine != 'inside_outside' or dmv_model.eisner_backend != 'numpy':
+        raise ValueError('the multiprocess E-step runs the numpy inside-outside engine only')
+    _estep_model = dmv_model
+    _estep_counter_shapes = (trans_counter.shape, decision_counter.shape)
+    if dmv_model.shared_param:
+        _estep_counter_shards = tuple(utils.alloc_array((workers,) + shape, True, dmv_model.memmap_dir,
+                                                        name + '_shards')
+                                      for shape, name in zip(_estep_counter_shapes,
+                                                             ['trans_counter', 'decision_counter']))
+    # log tables are built before forking so that workers share them
+    for name in ['trans_param', 'decision_param', 'sentence_trans_param']:
+        if getattr(dmv_model, name) is not None:
+            dmv_model.log_param(name)
+    training_likelihood = 0.0
+    en_likelihood = 0.0
+    context = multiprocessing.get_context('fork')
+    pool = context.Pool(workers, initializer=_init_worker, initargs=(context.Array('i', workers),))
+    try:
+        for sub_batch_likelihood, en_like, sub_trans_counter, sub_decision_counter, samples in \
+                pool.imap(_run_sub_batch, sub_batch_data):
+            training_likelihood += sub_batch_likelihood
+            en_likelihood += en_like
+            if sub_trans_counter is not None:
+                trans_counter += sub_trans_counter
+                decision_counter += sub_decision_counter
+            if samples is not None:
+                dmv_model.rule_samples.extend(samples[0])
+                dmv_model.decision_samples.extend(samples[1])
+    finally:
+        pool.close()
+        pool.join()
+    if _estep_counter_shards is not None:
+        trans_counter += np.sum(_estep_counter_shards[0], axis=0)
+        decision_counter += np.sum(_estep_counter_shards[1], axis=0)
+    _estep_model = _estep_counter_shapes = _estep_counter_shards = None
+    return training_likelihood, en_likelihood
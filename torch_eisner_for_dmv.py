@@ -0,0 +1,270 @@
+from builtins import range
+import numpy as np
+import torch
+from torch.utils.checkpoint import checkpoint
+
+import eisner_for_dmv
+import utils
+
+# Finite stand-in for log(0), filled into every chart of this module. batch_inside needs it to be finite because
+# the gradient of logsumexp over terms that are all -inf is NaN; outside and Viterbi charts use the same value so
+# that all tables of one sentence agree. Impossible entries stay at or below NEG_INF and never beat a possible one.
+NEG_INF = -1e30
+
+
+def batch_inside(batch_scores, batch_decision_score, valency_num, cvalency_num):
+    # Differentiable inside pass over torch tensors, processing all spans of one width together
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    index = utils.get_span_index(sentence_length)
+    width_index = index.widths
+    chart_size = index.chart_size
+    inside_complete_table = batch_scores.new_full((batch_size, chart_size, tag_num, valency_num), NEG_INF)
+    inside_incomplete_table = batch_scores.new_full((batch_size, chart_size, tag_num, tag_num, valency_num), NEG_INF)
+
+    inside_complete_table[:, index.basic_span] = batch_decision_score[:, :, :, :, :, 0].permute(0, 1, 3, 2, 4)[
+                                                 :, index.basic_pos, index.basic_dir]
+
+    for w in range(1, sentence_length):
+        # two complete spans to form an incomplete span
+        for dir in range(2):
+            ids = width_index[w][dir][0]
+            span_inside_i = _incomplete_span_score(inside_complete_table, batch_scores, batch_decision_score, w, dir,
+                                                   width_index[w][dir], valency_num, cvalency_num)
+            inside_incomplete_table[:, ids] = torch.logsumexp(span_inside_i, dim=2)
+
+        # one complete span and one incomplete span to form bigger complete span
+        for dir in range(2):
+            ids, span_ikcs, span_kjcs, _, _, _, _, _ = width_index[w][dir]
+            num_span = sentence_length - w
+            if dir == 0:
+                inside_ik_cc = inside_complete_table[:, :, :, 0][:, span_ikcs]
+                inside_kj_ic = inside_incomplete_table[:, span_kjcs]
+                span_inside_c = inside_ik_cc.view(batch_size, num_span, w, tag_num, 1, 1) + inside_kj_ic
+                inside_complete_table[:, ids] = torch.logsumexp(span_inside_c, dim=(2, 3))
+            else:
+                inside_ik_ic = inside_incomplete_table[:, span_ikcs]
+                inside_kj_cc = inside_complete_table[:, :, :, 0][:, span_kjcs]
+                span_inside_c = inside_ik_ic + inside_kj_cc.view(batch_size, num_span, w, 1, tag_num, 1)
+                inside_complete_table[:, ids] = torch.logsumexp(span_inside_c, dim=(2, 4))
+
+    partition_score = inside_complete_table[:, index.root_id, 0, 0]
+
+    return inside_complete_table, inside_incomplete_table, partition_score
+
+
+def _incomplete_span_score(complete_table, batch_scores, batch_decision_score, w, dir, span_index, valency_num,
+                           cvalency_num):
+    # Same as eisner_for_dmv._incomplete_span_score, padded split points score NEG_INF
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    _, _, _, span_ikis, span_kjis, _, _, _ = span_index
+    num_span = sentence_length - w
+    ik_ci = complete_table[:, :, :, dir][:, span_ikis]
+    kj_ci = complete_table[:, :, :, 1 - dir][:, span_kjis]
+    return _incomplete_split_score(ik_ci, kj_ci, batch_scores, batch_decision_score, w, dir, span_index, valency_num,
+                                   cvalency_num)
+
+
+def _incomplete_split_score(ik_ci, kj_ci, batch_scores, batch_decision_score, w, dir, span_index, valency_num,
+                            cvalency_num):
+    # Scores of the incomplete spans of width w and direction dir at every split point, given the complete spans on
+    # both sides of each split point, (batch, span, split point, tag) each
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    _, _, _, _, _, span_mask, heads, children = span_index
+    num_span = sentence_length - w
+    ik_ci = ik_ci.view(batch_size, num_span, w, tag_num, 1, 1)
+    kj_ci = kj_ci.view(batch_size, num_span, w, 1, tag_num, 1)
+    span_decision_score = batch_decision_score[:, :, :, dir, :, 1][:, heads]
+    # arcs that can not be taken score NEG_INF rather than -inf, which would make their gradients NaN
+    span_score = batch_scores[:, heads, children].clamp(min=NEG_INF)
+    if dir == 0:
+        # swap head-child to left-right position
+        span_score = span_score.transpose(2, 3)
+        span_decision_score = span_decision_score.view(batch_size, num_span, 1, 1, tag_num, valency_num)
+    else:
+        span_decision_score = span_decision_score.view(batch_size, num_span, 1, tag_num, 1, valency_num)
+    span_i = ik_ci + kj_ci + span_score.reshape(batch_size, num_span, 1, tag_num, tag_num, cvalency_num) \
+             + span_decision_score
+    if not span_mask.all():
+        span_i = span_i.masked_fill(torch.from_numpy(~span_mask).view(1, num_span, w, 1, 1, 1), NEG_INF)
+    return span_i
+
+
+def batch_outside(inside_complete_table, inside_incomplete_table, batch_scores, batch_decision_scores, valency_num,
+                  cvalency_num):
+    # Outside pass of eisner_for_dmv.batch_outside over torch tensors
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    index = utils.get_span_index(sentence_length)
+    width_index = index.widths
+    chart_size = index.chart_size
+    outside_complete_table = batch_scores.new_full((batch_size, chart_size, tag_num, valency_num), NEG_INF)
+    outside_incomplete_table = batch_scores.new_full((batch_size, chart_size, tag_num, tag_num, valency_num),
+                                                     NEG_INF)
+
+    outside_complete_table[:, index.root_id, 0, 0] = 0.0
+
+    for w in range(sentence_length - 1, 0, -1):
+        # complete span consists of one incomplete span and one complete span
+        for dir in range(2):
+            ids, span_ikcs, span_kjcs, _, _, _, _, _ = width_index[w][dir]
+            num_span = sentence_length - w
+            if dir == 0:
+                outside_ij_cc = outside_complete_table[:, ids].view(batch_size, num_span, 1, 1, tag_num, valency_num)
+                inside_kj_ic = inside_incomplete_table[:, span_kjcs]
+                inside_ik_cc = inside_complete_table[:, :, :, 0][:, span_ikcs].view(batch_size, num_span, w, tag_num,
+                                                                                   1, 1)
+                outside_ik_cc = torch.logsumexp(outside_ij_cc + inside_kj_ic, dim=(4, 5))
+                outside_kj_ic = outside_ij_cc + inside_ik_cc
+                _logaddexp_at(outside_complete_table[:, :, :, 0], span_ikcs, outside_ik_cc)
+                _logaddexp_at(outside_incomplete_table, span_kjcs, outside_kj_ic)
+            else:
+                outside_ij_cc = outside_complete_table[:, ids].view(batch_size, num_span, 1, tag_num, 1, valency_num)
+                inside_ik_ic = inside_incomplete_table[:, span_ikcs]
+                inside_kj_cc = inside_complete_table[:, :, :, 0][:, span_kjcs].view(batch_size, num_span, w, 1,
+                                                                                   tag_num, 1)
+                outside_kj_cc = torch.logsumexp(outside_ij_cc + inside_ik_ic, dim=(3, 5))
+                outside_ik_ic = outside_ij_cc + inside_kj_cc
+                _logaddexp_at(outside_complete_table[:, :, :, 0], span_kjcs, outside_kj_cc)
+                _logaddexp_at(outside_incomplete_table, span_ikcs, outside_ik_ic)
+
+        # incomplete span consists of two complete spans
+        for dir in range(2):
+            ids, _, _, span_ikis, span_kjis, span_mask, heads, children = width_index[w][dir]
+            num_span = sentence_length - w
+            outside_ij_ii = outside_incomplete_table[:, ids].view(batch_size, num_span, 1, tag_num, tag_num,
+                                                                  valency_num)
+            span_decision_scores = batch_decision_scores[:, :, :, dir, :, 1][:, heads]
+            if dir == 0:
+                # swap head-child to left-right position
+                span_scores = batch_scores[:, heads, children].transpose(2, 3)
+                span_decision_scores = span_decision_scores.view(batch_size, num_span, 1, tag_num, valency_num)
+            else:
+                span_scores = batch_scores[:, heads, children]
+                span_decision_scores = span_decision_scores.view(batch_size, num_span, tag_num, 1, valency_num)
+            outside_ij_ii = outside_ij_ii + (span_scores + span_decision_scores).reshape(batch_size, num_span, 1,
+                                                                                         tag_num, tag_num,
+                                                                                         valency_num)
+            # the complete span of the head takes decision valence 1, the one of the child decision valence 0
+            inside_ik_ci = inside_complete_table[:, :, :, dir][:, span_ikis]
+            inside_kj_ci = inside_complete_table[:, :, :, 1 - dir][:, span_kjis]
+            outside_ik_ci = torch.logsumexp(outside_ij_ii + inside_kj_ci.view(batch_size, num_span, w, 1, tag_num, 1),
+                                            dim=(4, 5))
+            outside_kj_ci = torch.logsumexp(outside_ij_ii + inside_ik_ci.view(batch_size, num_span, w, tag_num, 1, 1),
+                                            dim=(3, 5))
+            valid = torch.from_numpy(span_mask)
+            _logaddexp_at(outside_complete_table[:, :, :, dir], span_ikis[span_mask], outside_ik_ci[:, valid])
+            _logaddexp_at(outside_complete_table[:, :, :, 1 - dir], span_kjis[span_mask], outside_kj_ci[:, valid])
+
+    return outside_complete_table, outside_incomplete_table
+
+
+def _logaddexp_at(table, span_ids, span_scores):
+    # span_ids must not contain duplicates
+    table[:, span_ids] = torch.logaddexp(table[:, span_ids], span_scores)
+
+
+def batch_parse(batch_scores, batch_decision_score, valency_num, cvalency_num):
+    # Viterbi charts of eisner_for_dmv.batch_parse over torch tensors, decoded by eisner_for_dmv.batch_backtracking.
+    # Ties are broken as in the numpy version, so both give the same parse of every sentence that has one.
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    index = utils.get_span_index(sentence_length)
+    width_index = index.widths
+    chart_size = index.chart_size
+    complete_table = batch_scores.new_full((batch_size, chart_size, tag_num, valency_num), NEG_INF)
+    incomplete_table = batch_scores.new_full((batch_size, chart_size, tag_num, tag_num, valency_num), NEG_INF)
+    complete_backtrack = -torch.ones((batch_size, chart_size, tag_num, valency_num), dtype=torch.long)
+    incomplete_backtrack = -torch.ones((batch_size, chart_size, tag_num, tag_num, valency_num), dtype=torch.long)
+
+    complete_table[:, index.basic_span] = batch_decision_score[:, :, :, :, :, 0].permute(0, 1, 3, 2, 4)[
+                                          :, index.basic_pos, index.basic_dir]
+    for w in range(1, sentence_length):
+        # construct incomplete spans
+        for dir in range(2):
+            ids = width_index[w][dir][0]
+            span_i = _incomplete_span_score(complete_table, batch_scores, batch_decision_score, w, dir,
+                                            width_index[w][dir], valency_num, cvalency_num)
+            incomplete_table[:, ids], incomplete_backtrack[:, ids] = torch.max(span_i, dim=2)
+        # construct complete spans
+        for dir in range(2):
+            ids, span_ikcs, span_kjcs, _, _, _, _, _ = width_index[w][dir]
+            num_span = sentence_length - w
+            if dir == 0:
+                ik_cc = complete_table[:, :, :, 0][:, span_ikcs].view(batch_size, num_span, w, tag_num, 1, 1)
+                kj_ic = incomplete_table[:, span_kjcs]
+                span_c = ik_cc + kj_ic
+            else:
+                ik_ic = incomplete_table[:, span_ikcs]
+                kj_cc = complete_table[:, :, :, 0][:, span_kjcs].view(batch_size, num_span, w, 1, tag_num, 1)
+                span_c = (ik_ic + kj_cc).transpose(3, 4)
+            span_c = span_c.reshape(batch_size, num_span, w * tag_num, tag_num, valency_num)
+            complete_table[:, ids], complete_backtrack[:, ids] = torch.max(span_c, dim=2)
+
+    return eisner_for_dmv.batch_backtracking(incomplete_backtrack.numpy(), complete_backtrack.numpy(),
+                                             sentence_length, tag_num)
+
+
+def batch_expected_count(batch_scores, batch_decision_score, valency_num, cvalency_num):
+    # Expected counts are the gradients of the log partition function, so no outside pass is needed: arc counts are
+    # taken w.r.t. the incomplete spans, which hold one arc each at the valence of its head, and STOP counts w.r.t.
+    # the STOP scores. Returns arc counts (batch, head, child, valence), STOP counts (batch, position, direction,
+    # valence) and the log partition of each sentence, all as numpy arrays.
+    batch_size, sentence_length, _, tag_num, _, _ = batch_scores.shape
+    width_index = utils.get_span_index(sentence_length).widths
+    batch_scores = torch.from_numpy(batch_scores)
+    batch_decision_score = torch.tensor(np.maximum(batch_decision_score, NEG_INF), requires_grad=True)
+    complete, incomplete = _width_inside(batch_scores, batch_decision_score, valency_num, cvalency_num)
+    partition_score = complete[sentence_length - 1][1][:, 0, 0, 0]
+    spans = [(w, dir) for w in range(1, sentence_length) for dir in range(2)]
+    # spans that no tree uses, such as the root as a child, get no gradient
+    grads = torch.autograd.grad(partition_score.sum(),
+                                [batch_decision_score] + [incomplete[w][dir] for w, dir in spans], allow_unused=True)
+    stop_count = grads[0][:, :, :, :, :, 0].sum(dim=2).numpy()
+    arc_count = np.zeros((batch_size, sentence_length, sentence_length, valency_num))
+    for (w, dir), span_grad in zip(spans, grads[1:]):
+        if span_grad is not None:
+            heads, children = width_index[w][dir][6:]
+            arc_count[:, heads, children] = span_grad.sum(dim=(2, 3)).numpy()
+    return arc_count, stop_count, partition_score.detach().numpy()
+
+
+def _width_inside(batch_scores, batch_decision_score, valency_num, cvalency_num):
+    # Inside pass that keeps the spans of each width w and direction dir in tensors of their own, complete[w][dir] of
+    # shape (batch, left, tag, valence) and incomplete[w][dir] of shape (batch, left, tag, tag, valence). Each width
+    # is checkpointed, so backward keeps these tables only and recomputes the split point scores of one width at a
+    # time instead of holding those of all widths.
+    sentence_length = batch_scores.shape[1]
+    width_index = utils.get_span_index(sentence_length).widths
+    # single word spans, except the left span of the root
+    basic_score = batch_decision_score[:, :, :, :, :, 0]
+    root_left = torch.arange(sentence_length).view(1, sentence_length, 1, 1) == 0
+    complete = [[basic_score[:, :, :, 0].masked_fill(root_left, NEG_INF), basic_score[:, :, :, 1]]]
+    incomplete = [None]
+    for w in range(1, sentence_length):
+        incomplete_0, incomplete_1, complete_0, complete_1 = \
+            checkpoint(_width_inside_step, complete, incomplete, batch_scores, batch_decision_score, w,
+                       width_index[w], valency_num, cvalency_num, use_reentrant=False)
+        incomplete.append([incomplete_0, incomplete_1])
+        complete.append([complete_0, complete_1])
+    return complete, incomplete
+
+
+def _width_inside_step(complete, incomplete, batch_scores, batch_decision_score, w, width_index, valency_num,
+                       cvalency_num):
+    # Incomplete and complete spans of width w from the narrower ones. The sub-spans at split point t of all spans
+    # of one width are slices of the tensors of widths t and w - t.
+    num_span = batch_scores.shape[1] - w
+    # backward reruns this step on the full tables, so the spans of width w are kept apart from them
+    span_incomplete = []
+    for dir in range(2):
+        ik_ci = torch.stack([complete[t][1][:, :num_span, :, dir] for t in range(w)], dim=2)
+        kj_ci = torch.stack([complete[w - t - 1][0][:, t + 1:t + 1 + num_span, :, 1 - dir] for t in range(w)], dim=2)
+        span_i = _incomplete_split_score(ik_ci, kj_ci, batch_scores, batch_decision_score, w, dir, width_index[dir],
+                                         valency_num, cvalency_num)
+        span_incomplete.append(torch.logsumexp(span_i, dim=2))
+    ik_cc = torch.stack([complete[t][0][:, :num_span, :, 0] for t in range(w)], dim=2).unsqueeze(4).unsqueeze(5)
+    kj_ic = torch.stack([span_incomplete[0]] + [incomplete[w - t][0][:, t:t + num_span] for t in range(1, w)], dim=2)
+    complete_0 = torch.logsumexp(ik_cc + kj_ic, dim=(2, 3))
+    ik_ic = torch.stack([incomplete[t + 1][1][:, :num_span] for t in range(w - 1)] + [span_incomplete[1]], dim=2)
+    kj_cc = torch.stack([complete[w - t - 1][1][:, t + 1:t + 1 + num_span, :, 0] for t in range(w)],
+                        dim=2).unsqueeze(3).unsqueeze(5)
+    complete_1 = torch.logsumexp(ik_ic + kj_cc, dim=(2, 4))
+    return span_incomplete[0], span_incomplete[1], complete_0, complete_1
@@ -4,14 +4,22 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 from builtins import object
+import json
+import mmap
+import multiprocessing
+import os
 import re
 import random
 from collections import Counter
 from itertools import groupby
 import numpy as np
-import torch
-import torch.nn as nn
-from torch.nn.init import *
+# torch is only needed by the network helpers; the numpy chart algorithms and benchmark_eisner.py run without it
+try:
+    import torch
+    import torch.nn as nn
+    from torch.nn.init import *
+except ImportError:
+    torch = nn = None
 
 
 class ConllEntry(object):
@@ -58,6 +66,21 @@ def memoize(func):
     return helper
 
 
+def alloc_array(shape, shared, memmap_dir=None, name=None):
+    # Zero-filled float64 array. Shared arrays live in an anonymous shared mapping that forked processes see and
+    # write without copies, or in the file memmap_dir/name.dat when memmap_dir is given.
+    if not shared:
+        return np.zeros(shape)
+    if memmap_dir is not None:
+        path = os.path.join(memmap_dir, name + '.dat')
+        # a previous array of the same name stays valid for whoever still maps it
+        if os.path.exists(path):
+            os.remove(path)
+        return np.memmap(path, dtype=np.float64, mode='w+', shape=shape)
+    size = int(np.prod(shape))
+    return np.frombuffer(mmap.mmap(-1, max(size, 1) * 8), dtype=np.float64, count=size).reshape(shape)
+
+
 def construct_update_batch_data(data_list, batch_size):
     random.shuffle(data_list)
     batch_data = []
@@ -72,68 +95,228 @@ def construct_update_batch_data(data_list, batch_size):
     return batch_data
 
 
-@memoize
-def constituent_index(sentence_length, multiroot):
-    counter_id = 0
-    basic_span = []
-    id_2_span = {}
-    for left_idx in range(sentence_length):
-        for right_idx in range(left_idx, sentence_length):
+def _span_id(sentence_length, left, right, dir):
+    # id of span (left, right, dir) in the chart, elementwise for arrays. Spans with left <= right are numbered by
+    # width, direction and left index, so that the spans built in one step of the width-wise chart algorithms occupy
+    # a contiguous block of the chart
+    width = right - left
+    return width * (2 * sentence_length - width + 1) + dir * (sentence_length - width) + left
+
+
+class span_index(object):
+    # Chart layout of one sentence length as int arrays, for the width-wise chart algorithms. Spans are numbered by
+    # _span_id, so the spans of one width and direction occupy a contiguous block of the chart. The split points of
+    # each span are kept left to right in one row, padded with 0 to sentence_length - 1 columns: ikcs/kjcs build
+    # complete spans, ikis/kjis incomplete spans, and the masks mark the real split points.
+    # widths[w][dir] = (span id slice, ikcs, kjcs, ikis, kjis, ikis mask, head positions, child positions)
+    # holds the spans of width w and direction dir, with w split points each.
+    FIELDS = ['span_left', 'span_right', 'span_dir', 'ikcs', 'kjcs', 'ikis', 'kjis', 'complete_mask',
+              'incomplete_mask']
+
+    def __init__(self, sentence_length, arrays=None):
+        self.sentence_length = sentence_length
+        if arrays is None:
+            arrays = self.build_arrays(sentence_length)
+        for name in self.FIELDS:
+            setattr(self, name, arrays[name])
+        self.chart_size = len(self.span_left)
+        self.root_id = self.span_id(0, sentence_length - 1, 1)
+        # single word spans, except the left span of the root
+        self.basic_span = np.flatnonzero((self.span_left == self.span_right) & ((self.span_left > 0) |
+                                                                                (self.span_dir == 1)))
+        self.basic_pos = self.span_left[self.basic_span]
+        self.basic_dir = self.span_dir[self.basic_span]
+        self.widths = [None]
+        for w in range(1, sentence_length):
+            dir_index = []
+            lefts = np.arange(sentence_length - w)
+            rights = lefts + w
             for dir in range(2):
-                id_2_span[counter_id] = (left_idx, right_idx, dir)
-                counter_id += 1
-
-    span_2_id = {s: id for id, s in list(id_2_span.items())}
-
-    for i in range(sentence_length):
-        if i != 0:
-            id = span_2_id.get((i, i, 0))
-            basic_span.append(id)
-        id = span_2_id.get((i, i, 1))
-        basic_span.append(id)
-
-    ijss = []
-    ikcs = [[] for _ in range(counter_id)]
-    ikis = [[] for _ in range(counter_id)]
-    kjcs = [[] for _ in range(counter_id)]
-    kjis = [[] for _ in range(counter_id)]
-
-    for l in range(1, sentence_length):
-        for i in range(sentence_length - l):
-            j = i + l
-            for dir in range(2):
-                ids = span_2_id[(i, j, dir)]
-                for k in range(i, j + 1):
-                    if dir == 0:
-                        if k < j:
-                            # two complete spans to form an incomplete span
-                            idli = span_2_id[(i, k, dir + 1)]
-                            ikis[ids].append(idli)
-                            idri = span_2_id[(k + 1, j, dir)]
-                            kjis[ids].append(idri)
-                            # one complete span,one incomplete span to form a complete span
-                            idlc = span_2_id[(i, k, dir)]
-                            ikcs[ids].append(idlc)
-                            idrc = span_2_id[(k, j, dir)]
-                            kjcs[ids].append(idrc)
-
-                    else:
-                        if k < j and ((not (i == 0 and k != 0) and not multiroot) or multiroot):
-                            # two complete spans to form an incomplete span
-                            idli = span_2_id[(i, k, dir)]
-                            ikis[ids].append(idli)
-                            idri = span_2_id[(k + 1, j, dir - 1)]
-                            kjis[ids].append(idri)
-                        if k > i:
-                            # one incomplete span,one complete span to form a complete span
-                            idlc = span_2_id[(i, k, dir)]
-                            ikcs[ids].append(idlc)
-                            idrc = span_2_id[(k, j, dir)]
-                            kjcs[ids].append(idrc)
-
-                ijss.append(ids)
-
-    return span_2_id, id_2_span, ijss, ikcs, ikis, kjcs, kjis, basic_span
+                first_id = self.span_id(0, w, dir)
+                ids = slice(first_id, first_id + sentence_length - w)
+                if dir == 0:
+                    heads, children = rights, lefts
+                else:
+                    heads, children = lefts, rights
+                dir_index.append((ids, self.ikcs[ids, :w], self.kjcs[ids, :w], self.ikis[ids, :w], self.kjis[ids, :w],
+                                  self.incomplete_mask[ids, :w], heads, children))
+            self.widths.append(dir_index)
+
+    def span_id(self, left, right, dir):
+        return _span_id(self.sentence_length, left, right, dir)
+
+    @staticmethod
+    def build_arrays(sentence_length):
+        spans = np.array([(left, left + width, dir) for width in range(sentence_length) for dir in range(2)
+                          for left in range(sentence_length - width)], dtype=int)
+        left, right, dir = [spans[:, i, np.newaxis] for i in range(3)]
+        split = np.arange(max(sentence_length - 1, 1))
+        k = left + split
+        complete_mask = split < right - left
+        # spans headed by the root take a single child
+        incomplete_mask = complete_mask & ((left > 0) | (dir == 0) | (split == 0))
+        arrays = {'span_left': spans[:, 0], 'span_right': spans[:, 1], 'span_dir': spans[:, 2],
+                  'complete_mask': complete_mask, 'incomplete_mask': incomplete_mask}
+        # two complete spans to form an incomplete span
+        arrays['ikis'] = np.where(incomplete_mask, _span_id(sentence_length, left, k, 1), 0)
+        arrays['kjis'] = np.where(incomplete_mask, _span_id(sentence_length, k + 1, right, 0), 0)
+        # one complete span and one incomplete span to form a complete span, split points of right spans start at
+        # left + 1
+        k = k + dir
+        arrays['ikcs'] = np.where(complete_mask, _span_id(sentence_length, left, k, dir), 0)
+        arrays['kjcs'] = np.where(complete_mask, _span_id(sentence_length, k, right, dir), 0)
+        return arrays
+
+
+_span_indexes = {}
+
+
+def get_span_index(sentence_length):
+    # span_index of one sentence length, built once per process unless loaded by load_span_index_cache
+    if sentence_length not in _span_indexes:
+        _span_indexes[sentence_length] = span_index(sentence_length)
+    return _span_indexes[sentence_length]
+
+
+SPAN_INDEX_CACHE_VERSION = 1
+
+
+def _span_index_cache_path(cache_dir):
+    return os.path.join(cache_dir, 'span_index.npz')
+
+
+def write_span_index_cache(cache_dir, max_length):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    arrays = {'version': np.array(SPAN_INDEX_CACHE_VERSION), 'max_length': np.array(max_length)}
+    for sentence_length in range(1, max_length + 1):
+        index = get_span_index(sentence_length)
+        for name in span_index.FIELDS:
+            array = getattr(index, name)
+            # span ids are stored in the smallest int type and compressed, the tables are very regular
+            if array.dtype.kind == 'i':
+                array = array.astype(np.min_scalar_type(-index.chart_size))
+            arrays['%d_%s' % (sentence_length, name)] = array
+    cache_path = _span_index_cache_path(cache_dir)
+    with open(cache_path + '.tmp', 'wb') as cache_fp:
+        np.savez_compressed(cache_fp, **arrays)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def load_span_index_cache(cache_dir, max_length):
+    # Load the span indexes of all sentence lengths up to max_length from cache_dir. They are built and written
+    # there first when the cache is missing, stale or covers shorter sentences only.
+    cache_path = _span_index_cache_path(cache_dir)
+    try:
+        with np.load(cache_path) as cache:
+            valid = int(cache['version']) == SPAN_INDEX_CACHE_VERSION and int(cache['max_length']) >= max_length
+    except (IOError, OSError, ValueError, KeyError):
+        valid = False
+    if not valid:
+        write_span_index_cache(cache_dir, max_length)
+    with np.load(cache_path) as cache:
+        for sentence_length in range(1, max_length + 1):
+            arrays = {}
+            for name in span_index.FIELDS:
+                array = cache['%d_%s' % (sentence_length, name)]
+                arrays[name] = array.astype(int) if array.dtype.kind == 'i' else array
+            _span_indexes[sentence_length] = span_index(sentence_length, arrays)
+
+
+# Fields of neural training samples collected in the E-step
+RULE_SAMPLE_FIELDS = [('head_pos', np.int32), ('child_pos', np.int32), ('dir', np.int8), ('cvalency', np.int8),
+                      ('sentence', np.int32), ('language', np.int32), ('count', np.float32)]
+DECISION_SAMPLE_FIELDS = [('pos', np.int32), ('dir', np.int8), ('dvalency', np.int8), ('sentence', np.int32),
+                          ('language', np.int32), ('decision', np.int8), ('count', np.float32)]
+
+
+class sample_buffer(object):
+    # Growable columnar storage for training samples, one typed array per field
+    def __init__(self, fields, capacity=1024):
+        self.fields = fields
+        self.size = 0
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in fields}
+
+    def __len__(self):
+        return self.size
+
+    def append(self, *columns):
+        # columns are given in field order and broadcast against each other, all samples are appended at once
+        columns = [np.ravel(c) for c in np.broadcast_arrays(*columns)]
+        new_size = self.size + len(columns[0])
+        capacity = len(self.columns[self.fields[0][0]])
+        if new_size > capacity:
+            capacity = max(new_size, 2 * capacity)
+            for name, dtype in self.fields:
+                column = np.zeros(capacity, dtype=dtype)
+                column[:self.size] = self.columns[name][:self.size]
+                self.columns[name] = column
+        for (name, _), c in zip(self.fields, columns):
+            self.columns[name][self.size:new_size] = c
+        self.size = new_size
+
+    def extend(self, samples):
+        self.append(*[samples.column(name) for name, _ in self.fields])
+
+    def column(self, name, index=None):
+        column = self.columns[name][:self.size]
+        return column if index is None else column[index]
+
+    def aggregate(self, key_fields):
+        # One sample per distinct combination of key_fields with the counts summed; other fields are set to 0
+        keys = [self.column(name).astype(np.int64) for name in key_fields]
+        key_dims = [int(k.max()) + 1 if len(k) > 0 else 1 for k in keys]
+        unique_keys, inverse = np.unique(np.ravel_multi_index(keys, key_dims), return_inverse=True)
+        aggregated = sample_buffer(self.fields, max(len(unique_keys), 1))
+        aggregated.size = len(unique_keys)
+        for name, key in zip(key_fields, np.unravel_index(unique_keys, key_dims)):
+            aggregated.columns[name][:aggregated.size] = key
+        aggregated.columns['count'][:aggregated.size] = np.bincount(inverse, weights=self.column('count'),
+                                                                     minlength=len(unique_keys))
+        return aggregated
+
+
+class sentence_param(object):
+    # Per-sentence transition parameters indexed like a dense (sentence, head_pos, child_pos, direction, cvalency)
+    # array, but only the rows of head POS occurring in a sentence are stored
+    def __init__(self, sentence_pos, pos_num, cvalency, row_index=None, shared=False, memmap_dir=None, name=None):
+        if row_index is None:
+            row_index = -np.ones((len(sentence_pos), pos_num), dtype=np.int32)
+            row_num = 0
+            for s, s_pos in enumerate(sentence_pos):
+                head_pos = np.unique(s_pos)
+                row_index[s, head_pos] = np.arange(row_num, row_num + len(head_pos))
+                row_num += len(head_pos)
+        self.row_index = row_index
+        self.shape = (len(row_index), pos_num, pos_num, 2, cvalency)
+        self.values = alloc_array((int(row_index.max()) + 1, pos_num, 2, cvalency), shared, memmap_dir, name)
+
+    def head_pos(self, sentence_id):
+        return np.flatnonzero(self.row_index[sentence_id] >= 0)
+
+    def __getitem__(self, index):
+        return self.values[(self.row_index[index[0], index[1]],) + tuple(index[2:])]
+
+    def __setitem__(self, index, value):
+        if index is Ellipsis:
+            self.values[...] = value.values
+        else:
+            self.values[(self.row_index[index[0], index[1]],) + tuple(index[2:])] = value
+
+    def copy(self):
+        param = self.empty_like(False, None, None)
+        param.values[...] = self.values
+        return param
+
+    def empty_like(self, shared, memmap_dir, name):
+        return sentence_param(None, self.shape[1], self.shape[4], self.row_index, shared, memmap_dir, name)
+
+
+def alloc_like(array, shared, memmap_dir=None, name=None):
+    # alloc_array for the layout of array, which may be a sentence_param
+    if isinstance(array, sentence_param):
+        return array.empty_like(shared, memmap_dir, name)
+    return alloc_array(array.shape, shared, memmap_dir, name)
 
 
 class data_sentence(object):
@@ -193,6 +376,205 @@ def read_conll(fh):
         yield tokens
 
 
+class conll_corpus(object):
+    # Sentences as contiguous token columns: POS ids into pos_vocab and gold heads of all tokens, root included.
+    # Sentence s holds tokens offsets[s]:offsets[s + 1] and has language id language[s] into language_vocab.
+    # When the source files are known, sentence s starts at byte source_offset[s] of source_paths[source[s]] and
+    # its full entries are read from there on demand.
+    def __init__(self, pos, head, offsets, language, pos_vocab, language_vocab, source_paths=None, source=None,
+                 source_offset=None):
+        self.pos = pos
+        self.head = head
+        self.offsets = offsets
+        self.language = language
+        self.pos_vocab = pos_vocab
+        self.language_vocab = language_vocab
+        self.source_paths = source_paths
+        self.source = source
+        self.source_offset = source_offset
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def sentence_pos(self, s):
+        return self.pos[self.offsets[s]:self.offsets[s + 1]]
+
+    def sentence_head(self, s):
+        return self.head[self.offsets[s]:self.offsets[s + 1]]
+
+    def sentence_entries(self, s):
+        # Entries of sentence s as read_conll gives them, ConllEntry objects with the root first
+        lines = []
+        with open(self.source_paths[self.source[s]], 'rb') as conllFP:
+            conllFP.seek(int(self.source_offset[s]))
+            for line in conllFP:
+                line = line.decode('utf-8')
+                if line.strip() == '':
+                    break
+                lines.append(line)
+        return next(read_conll(lines))
+
+    def map_pos(self, pos):
+        # POS ids of all tokens in the pos dictionary, -1 for tags it does not have
+        return np.array([pos.get(p, -1) for p in self.pos_vocab], dtype=int)[self.pos]
+
+    @staticmethod
+    def concatenate(corpora):
+        # One corpus from several; vocabularies are merged in order of first occurrence
+        corpora = [corpus for corpus in corpora if len(corpus) > 0]
+        pos_vocab = {}
+        language_vocab = {}
+        pos, head, offsets, language = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int32)], \
+                                       [np.zeros(1, dtype=int)], [np.zeros(0, dtype=int)]
+        token_num = 0
+        for corpus in corpora:
+            pos_id = np.array([pos_vocab.setdefault(p, len(pos_vocab)) for p in corpus.pos_vocab], dtype=np.int32)
+            language_id = np.array([language_vocab.setdefault(l, len(language_vocab)) for l in corpus.language_vocab],
+                                   dtype=int)
+            pos.append(pos_id[corpus.pos])
+            head.append(np.asarray(corpus.head, dtype=np.int32))
+            offsets.append(np.asarray(corpus.offsets[1:], dtype=int) + token_num)
+            language.append(language_id[corpus.language])
+            token_num += int(corpus.offsets[-1])
+        source_paths = source = source_offset = None
+        if all(corpus.source_paths is not None for corpus in corpora):
+            source_paths = []
+            source = [np.zeros(0, dtype=int)]
+            source_offset = [np.zeros(0, dtype=int)]
+            for corpus in corpora:
+                source.append(np.asarray(corpus.source, dtype=int) + len(source_paths))
+                source_offset.append(np.asarray(corpus.source_offset, dtype=int))
+                source_paths.extend(corpus.source_paths)
+            source = np.concatenate(source)
+            source_offset = np.concatenate(source_offset)
+        return conll_corpus(np.concatenate(pos), np.concatenate(head), np.concatenate(offsets),
+                            np.concatenate(language), list(pos_vocab.keys()), list(language_vocab.keys()),
+                            source_paths, source, source_offset)
+
+
+def read_conll_file(conll_path, language_key):
+    # conll_corpus of one treebank file, tags are numbered in order of first occurrence. Only the POS and head
+    # columns are kept, in the sentences and tokens read_conll would give; other fields stay in the file.
+    pos_vocab = {}
+    pos = []
+    head = []
+    offsets = [0]
+    source_offset = []
+    line_start = 0
+    sentence_lines = 0
+    with open(conll_path, 'rb') as conllFP:
+        for line in conllFP:
+            line_end = line_start + len(line)
+            line = line.decode('utf-8').strip()
+            if line == '':
+                if sentence_lines > 0:
+                    offsets.append(len(pos))
+                sentence_lines = 0
+            else:
+                if sentence_lines == 0:
+                    source_offset.append(line_start)
+                    pos.append(pos_vocab.setdefault('ROOT-POS', len(pos_vocab)))
+                    head.append(-1)
+                sentence_lines += 1
+                tok = line.split('\t')
+                if not (line[0] == '#' or '-' in tok[0] or '.' in tok[0]):
+                    pos.append(pos_vocab.setdefault(tok[3].upper(), len(pos_vocab)))
+                    head.append(int(tok[6]) if tok[6] != '_' else -1)
+            line_start = line_end
+    if sentence_lines > 0:
+        offsets.append(len(pos))
+    return conll_corpus(np.array(pos, dtype=np.int32), np.array(head, dtype=np.int32), np.array(offsets, dtype=int),
+                        np.zeros(len(offsets) - 1, dtype=int), list(pos_vocab.keys()), [language_key], [conll_path],
+                        np.zeros(len(offsets) - 1, dtype=int), np.array(source_offset, dtype=int))
+
+
+CORPUS_CACHE_VERSION = 2
+
+
+def _corpus_cache_signature(source_path):
+    source_stat = os.stat(source_path)
+    return [CORPUS_CACHE_VERSION, source_stat.st_size, source_stat.st_mtime_ns]
+
+
+def read_corpus_cache(data_path, file, cache_dir):
+    # conll_corpus of data_path/file memory mapped from cache_dir, None when the cache is missing or stale
+    language_key, _ = get_language_key(file)
+    source_path = os.path.join(data_path, file)
+    cache_path = os.path.join(cache_dir, file)
+    try:
+        with open(cache_path + '.json', 'r') as meta_fp:
+            meta = json.load(meta_fp)
+        if meta['signature'] != _corpus_cache_signature(source_path):
+            return None
+        tokens = np.load(cache_path + '.tokens.npy', mmap_mode='r')
+        offsets = np.load(cache_path + '.offsets.npy', mmap_mode='r')
+        source_offset = np.load(cache_path + '.sources.npy', mmap_mode='r')
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return conll_corpus(tokens[0], tokens[1], offsets, np.zeros(len(offsets) - 1, dtype=int), meta['pos_vocab'],
+                        [language_key], [source_path], np.zeros(len(offsets) - 1, dtype=int), source_offset)
+
+
+def write_corpus_cache(corpus, data_path, file, cache_dir):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_path = os.path.join(cache_dir, file)
+    # arrays first, the metadata that validates them last
+    for suffix, array in [('.tokens.npy', np.stack([corpus.pos, corpus.head])), ('.offsets.npy', corpus.offsets),
+                          ('.sources.npy', corpus.source_offset)]:
+        with open(cache_path + suffix + '.tmp', 'wb') as array_fp:
+            np.save(array_fp, array)
+        os.replace(cache_path + suffix + '.tmp', cache_path + suffix)
+    with open(cache_path + '.json.tmp', 'w') as meta_fp:
+        json.dump({'signature': _corpus_cache_signature(os.path.join(data_path, file)),
+                   'pos_vocab': corpus.pos_vocab}, meta_fp)
+    os.replace(cache_path + '.json.tmp', cache_path + '.json')
+
+
+def load_conll_file(data_path, file, cache_dir=None):
+    # conll_corpus of data_path/file. With cache_dir, the parsed columns are kept there as .npy files and memory
+    # mapped by later runs while the size and mtime of the source file are unchanged.
+    if cache_dir is not None:
+        corpus = read_corpus_cache(data_path, file, cache_dir)
+        if corpus is not None:
+            return corpus
+    language_key, _ = get_language_key(file)
+    corpus = read_conll_file(os.path.join(data_path, file), language_key)
+    if cache_dir is not None:
+        write_corpus_cache(corpus, data_path, file, cache_dir)
+    return corpus
+
+
+def _load_conll_file_task(task):
+    return load_conll_file(*task)
+
+
+def iter_conll_files(data_path, files, cache_dir=None, workers=0):
+    # conll_corpus of every file in order, each yielded as soon as it is read. With workers, the files that are
+    # not cached are parsed ahead of the consumer by a pool of processes.
+    files = list(files)
+    if cache_dir is None:
+        cached = [None] * len(files)
+    else:
+        cached = [read_corpus_cache(data_path, file, cache_dir) for file in files]
+    tasks = [(data_path, file, cache_dir) for file, corpus in zip(files, cached) if corpus is None]
+    if workers <= 0 or len(tasks) == 0:
+        for file, corpus in zip(files, cached):
+            yield corpus if corpus is not None else load_conll_file(data_path, file, cache_dir)
+        return
+    pool = multiprocessing.get_context('fork').Pool(min(workers, len(tasks)))
+    try:
+        parsed = pool.imap(_load_conll_file_task, tasks)
+        for corpus in cached:
+            yield corpus if corpus is not None else next(parsed)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def read_data(conll_path, isPredict):
     sentences = []
     if not isPredict:
@@ -230,6 +612,12 @@ def construct_batch_data(data_list, batch_size):
     return batch_data
 
 
+def construct_bucket_batch_data(data_list, batch_size):
+    # Batches of batch_size sentences of similar length: sentences are sorted by length and cut into batches, which
+    # are padded to their longest sentence by the E-step and the parser
+    return get_batch_data(sorted(data_list, key=lambda x: len(x[0])), batch_size)
+
+
 def get_batch_data(grouped_data, batch_size):
     batch_data = []
     len_datas = len(grouped_data)
@@ -340,69 +728,6 @@ def write_distribution(dmv_model):
                     lex_writer.write('\n')
 
 
-def construct_input_data(rule_samples, decision_samples, batch_size, em_type):
-    batch_input_data = {}
-    batch_target_data = {}
-    batch_decision_data = {}
-    batch_target_decision_data = {}
-
-    batch_rule_samples = construct_update_batch_data(rule_samples, batch_size)
-    batch_decision_samples = construct_update_batch_data(decision_samples, batch_size)
-    batch_input_pos_list = list()
-    batch_input_dir_list = list()
-    batch_cvalency_list = list()
-    batch_dvalency_list = list()
-    batch_target_pos_list = list()
-    batch_decision_pos_list = list()
-    batch_decision_dir_list = list()
-    batch_target_decision_list = list()
-    if em_type == 'em':
-        batch_target_count_list = list()
-        batch_target_decision_count_list = list()
-
-    for i in range(len(batch_rule_samples)):
-        one_batch = np.array(batch_rule_samples[i])
-        one_batch_input_pos = one_batch[:, 0]
-        one_batch_input_dir = one_batch[:, 4]
-        one_batch_cvalency = one_batch[:, 5]
-        one_batch_target_pos = one_batch[:, 1]
-        batch_input_pos_list.append(one_batch_input_pos)
-        batch_input_dir_list.append(one_batch_input_dir)
-        batch_cvalency_list.append(one_batch_cvalency)
-        batch_target_pos_list.append(one_batch_target_pos)
-        if em_type == 'em':
-            one_batch_target_count = one_batch[:, 6]
-            batch_target_count_list.append(one_batch_target_count)
-    batch_input_data['input_pos'] = batch_input_pos_list
-    batch_input_data['input_dir'] = batch_input_dir_list
-    batch_input_data['cvalency'] = batch_cvalency_list
-    batch_target_data['target_pos'] = batch_target_pos_list
-    if em_type == 'em':
-        batch_target_data['target_count'] = batch_target_count_list
-
-    for i in range(len(batch_decision_samples)):
-        one_batch = np.array(batch_decision_samples[i])
-        one_batch_decision_pos = one_batch[:, 0]
-        one_batch_decision_dir = one_batch[:, 2]
-        one_batch_dvalency = one_batch[:, 3]
-        one_batch_target_decision = one_batch[:, 4]
-        batch_decision_pos_list.append(one_batch_decision_pos)
-        batch_decision_dir_list.append(one_batch_decision_dir)
-        batch_dvalency_list.append(one_batch_dvalency)
-        batch_target_decision_list.append(one_batch_target_decision)
-        if em_type == 'em':
-            one_batch_target_decision_count = one_batch[:, 5]
-            batch_target_decision_count_list.append(one_batch_target_decision_count)
-    batch_decision_data['decision_pos'] = batch_decision_pos_list
-    batch_decision_data['dvalency'] = batch_dvalency_list
-    batch_decision_data['decision_dir'] = batch_decision_dir_list
-    batch_target_decision_data['decision_target'] = batch_target_decision_list
-    if em_type == 'em':
-        batch_target_decision_data['decision_target_count'] = batch_target_decision_count_list
-
-    return batch_input_data, batch_target_data, batch_decision_data, batch_target_decision_data
-
-
 def read_language_list(language_path):
     ll = open(language_path, 'r')
     language_set = set()
@@ -412,16 +737,17 @@ def read_language_list(language_path):
     return language_set
 
 
+UD_FILE_PATTERN = re.compile(r'^([^-]+)-ud-(train|dev|test)[-.]')
+
+
 def get_file_set(file_list, language_set, is_train):
+    # Training files, or test files for evaluation, of the languages in language_set. Names are
+    # <language>-ud-<train|dev|test>..., other files are left out.
+    part = 'train' if is_train else 'test'
     file_set = set()
     for file in file_list:
-        if not file[0].isalpha():
-            continue
-        language_key, counter = get_language_key(file)
-        function_key = file[counter + 6]
-        if is_train and function_key == "a" and language_key in language_set:
-            file_set.add(file)
-        elif not is_train and function_key == "s" and language_key in language_set:
+        file_match = UD_FILE_PATTERN.match(os.path.basename(file))
+        if file_match and file_match.group(2) == part and file_match.group(1) in language_set:
             file_set.add(file)
     return file_set
 
@@ -439,128 +765,79 @@ def get_language_key(file):
     return key, counter
 
 
-def read_multiple_data(data_path, file_set, isPredict):
-    sentences = []
-    language_map = {}
-    s_counter = 0
-    if not isPredict:
-        posCount = Counter()
-        lanCounter = Counter()
-        for file in file_set:
-            one_data_path = data_path + "/" + file
-            language_key, _ = get_language_key(file)
-            with open(one_data_path, 'r') as conllFP:
-                for sentence in read_conll(conllFP):
-                    # wordsCount.update([node.norm for node in sentence if isinstance(node, ConllEntry)])
-                    posCount.update([node.pos for node in sentence if isinstance(node, ConllEntry)])
-                    ds = data_sentence(s_counter, sentence)
-                    sentences.append(ds)
-                    language_map[s_counter] = language_key
-                    lanCounter.update([language_key])
-                    s_counter += 1
-        # wordsCount['<UNKNOWN>'] = 0
-        # posCount['<UNKNOWN-POS>'] = 0
-        # return {w: i for i, w in enumerate(wordsCount.keys())}, {p: i for i, p in enumerate(
-        return {p: i for i, p in enumerate(posCount.keys())}, sentences, {l: i for i, l in
-                                                                          enumerate(lanCounter.keys())}, language_map
-    else:
-        for file in file_set:
-            one_data_path = data_path + "/" + file
-            language_key, _ = get_language_key(file)
-            with open(one_data_path, 'r') as conllFP:
-                for sentence in read_conll(conllFP):
-                    ds = data_sentence(s_counter, sentence)
-                    sentences.append(ds)
-                    language_map[s_counter] = language_key
-                    s_counter += 1
-        return sentences, language_map
-
-
-def construct_ml_batch_data(data_list, sentence_map, batch_size, sen_dim):
-    data_list.sort(key=lambda x: len(sentence_map[x[sen_dim]]))
-    grouped = [list(g) for k, g in groupby(data_list, lambda s: len(sentence_map[s[sen_dim]]))]
-    batch_data = []
-    for group in grouped:
-        sub_batch_data = get_batch_data(group, batch_size)
-        batch_data.extend(sub_batch_data)
+def read_multiple_data(data_path, file_set, isPredict, cache_dir=None, workers=0):
+    # All sentences of file_set as one conll_corpus, with the language key of every sentence. For training data,
+    # also the POS and language dictionaries, numbered in order of first occurrence.
+    corpus = conll_corpus.concatenate(iter_conll_files(data_path, file_set, cache_dir, workers))
+    language_map = {s: corpus.language_vocab[l] for s, l in enumerate(corpus.language)}
+    if isPredict:
+        return corpus, language_map
+    return {p: i for i, p in enumerate(corpus.pos_vocab)}, corpus, {l: i for i, l in
+                                                                  enumerate(corpus.language_vocab)}, language_map
+
+
+def construct_ml_batch_data(samples, batch_size):
+    # Shuffled batches of sample indices. Sentences of different lengths share batches since the sentence encoder
+    # takes padded batches
+    batch_data = get_batch_data(np.arange(len(samples)), batch_size)
     random.shuffle(batch_data)
     return batch_data
 
 
-def construct_ml_input_data(rule_samples, decision_samples, sentence_map, sample_batch_size, em_type):
+def index_grid(shape):
+    # One LongTensor per axis holding the indices of every entry of a table of the given shape, in C order
+    return [torch.from_numpy(axis_index) for axis_index in np.indices(shape).reshape(len(shape), -1)]
+
+
+def sample_tensors(samples):
+    # Columns of a sample buffer as tensors, counts as FloatTensor and everything else as LongTensor
+    return {name: torch.from_numpy(samples.column(name)).float() if name == 'count' else
+            torch.from_numpy(samples.column(name)).long() for name, _ in samples.fields}
+
+
+def pad_batch_pos(batch_pos):
+    # POS sequences of a batch as one array padded with 0, and their lengths
+    batch_len = np.array([len(p) for p in batch_pos], dtype=int)
+    padded = np.zeros((len(batch_pos), batch_len.max()), dtype=int)
+    padded[np.arange(padded.shape[1]) < batch_len[:, None]] = np.concatenate(batch_pos)
+    return padded, batch_len
+
+
+def pad_sentences(sentences):
+    # Padded LongTensor of POS sequences and a LongTensor of their lengths, for the packed sentence encoder
+    padded, sentences_len = pad_batch_pos(sentences)
+    return torch.LongTensor(padded), torch.LongTensor(sentences_len)
+
+
+def construct_ml_input_data(rule_samples, decision_samples, sample_batch_size, em_type):
     batch_input_data = {}
     batch_target_data = {}
     batch_decision_data = {}
     batch_target_decision_data = {}
-    batch_rule_samples = construct_ml_batch_data(rule_samples, sentence_map, sample_batch_size, 4)
-    batch_decision_samples = construct_ml_batch_data(decision_samples, sentence_map, sample_batch_size, 4)
-    batch_input_pos_list = list()
-    batch_input_dir_list = list()
-    batch_input_sen_list = list()
-    batch_cvalency_list = list()
-    batch_dvalency_list = list()
-    batch_lan_list = list()
-    batch_target_pos_list = list()
-    batch_decision_pos_list = list()
-    batch_decision_dir_list = list()
-    batch_decision_sen_list = list()
-    batch_decision_lan_list = list()
-    batch_target_decision_list = list()
-    if em_type == 'em':
-        batch_target_count_list = list()
-        batch_target_decision_count_list = list()
-
-    for i in range(len(batch_rule_samples)):
-        one_batch = np.array(batch_rule_samples[i])
-        one_batch_input_pos = one_batch[:, 0]
-        one_batch_input_dir = one_batch[:, 2]
-        one_batch_cvalency = one_batch[:, 3]
-        one_batch_sentence = one_batch[:, 4]
-        one_batch_target_pos = one_batch[:, 1]
-        one_batch_target_lan = one_batch[:, 5]
-        batch_input_pos_list.append(one_batch_input_pos)
-        batch_input_dir_list.append(one_batch_input_dir)
-        batch_cvalency_list.append(one_batch_cvalency)
-        batch_input_sen_list.append(one_batch_sentence)
-        batch_target_pos_list.append(one_batch_target_pos)
-        batch_lan_list.append(one_batch_target_lan)
-        if em_type == 'em':
-            one_batch_target_count = one_batch[:, 6]
-            batch_target_count_list.append(one_batch_target_count)
-    batch_input_data['input_pos'] = batch_input_pos_list
-    batch_input_data['input_dir'] = batch_input_dir_list
-    batch_input_data['cvalency'] = batch_cvalency_list
-    batch_input_data['sentence'] = batch_input_sen_list
-    batch_target_data['target_pos'] = batch_target_pos_list
-    batch_target_data['target_lan'] = batch_lan_list
+    batch_rule_samples = construct_ml_batch_data(rule_samples, sample_batch_size)
+    batch_decision_samples = construct_ml_batch_data(decision_samples, sample_batch_size)
+
+    batch_input_data['input_pos'] = [rule_samples.column('head_pos', b) for b in batch_rule_samples]
+    batch_input_data['input_dir'] = [rule_samples.column('dir', b) for b in batch_rule_samples]
+    batch_input_data['cvalency'] = [rule_samples.column('cvalency', b) for b in batch_rule_samples]
+    batch_input_data['sentence'] = [rule_samples.column('sentence', b) for b in batch_rule_samples]
+    batch_target_data['target_pos'] = [rule_samples.column('child_pos', b) for b in batch_rule_samples]
+    batch_target_data['target_lan'] = [rule_samples.column('language', b) for b in batch_rule_samples]
     if em_type == 'em':
-        batch_target_data['target_count'] = batch_target_count_list
-
-    for i in range(len(batch_decision_samples)):
-        one_batch = np.array(batch_decision_samples[i])
-        one_batch_decision_pos = one_batch[:, 0]
-        one_batch_decision_dir = one_batch[:, 1]
-        one_batch_dvalency = one_batch[:, 2]
-        one_batch_decision_sentence = one_batch[:, 3]
-        one_batch_decision_lan = one_batch[:, 4]
-        one_batch_target_decision = one_batch[:, 5]
-        batch_decision_pos_list.append(one_batch_decision_pos)
-        batch_decision_dir_list.append(one_batch_decision_dir)
-        batch_dvalency_list.append(one_batch_dvalency)
-        batch_decision_sen_list.append(one_batch_decision_sentence)
-        batch_decision_lan_list.append(one_batch_decision_lan)
-        batch_target_decision_list.append(one_batch_target_decision)
-        if em_type == 'em':
-            one_batch_target_decision_count = one_batch[:, 6]
-            batch_target_decision_count_list.append(one_batch_target_decision_count)
-    batch_decision_data['decision_pos'] = batch_decision_pos_list
-    batch_decision_data['dvalency'] = batch_dvalency_list
-    batch_decision_data['decision_dir'] = batch_decision_dir_list
-    batch_decision_data['decision_sentence'] = batch_decision_sen_list
-    batch_decision_data['decision_language'] = batch_decision_lan_list
-    batch_target_decision_data['decision_target'] = batch_target_decision_list
+        batch_target_data['target_count'] = [rule_samples.column('count', b) for b in batch_rule_samples]
+
+    batch_decision_data['decision_pos'] = [decision_samples.column('pos', b) for b in batch_decision_samples]
+    batch_decision_data['dvalency'] = [decision_samples.column('dvalency', b) for b in batch_decision_samples]
+    batch_decision_data['decision_dir'] = [decision_samples.column('dir', b) for b in batch_decision_samples]
+    batch_decision_data['decision_sentence'] = [decision_samples.column('sentence', b) for b in
+                                                batch_decision_samples]
+    batch_decision_data['decision_language'] = [decision_samples.column('language', b) for b in
+                                                batch_decision_samples]
+    batch_target_decision_data['decision_target'] = [decision_samples.column('decision', b) for b in
+                                                     batch_decision_samples]
     if em_type == 'em':
-        batch_target_decision_data['decision_target_count'] = batch_target_decision_count_list
+        batch_target_decision_data['decision_target_count'] = [decision_samples.column('count', b) for b in
+                                                               batch_decision_samples]
 
     return batch_input_data, batch_target_data, batch_decision_data, batch_target_decision_data
 
@@ -581,21 +858,18 @@ def construct_ml_predict_data(rule_samples):
     return batch_predict_data
 
 
-def construct_ml_pos_data(sentences, pos, languages, language_map):
+def construct_ml_pos_data(corpus, pos, languages, language_map):
+    # Tokens whose tag is not in pos are left out
     data_list = list()
-    sen_idx = 0
     sentence_map = {}
     data_pos = []
-    for s in sentences:
-        _, s_pos = s.set_data_list(None, pos)
-        s_data_list = list()
-        s_data_list.append(s_pos)
+    corpus_pos = corpus.map_pos(pos)
+    for sen_idx in range(len(corpus)):
+        s_pos = corpus_pos[corpus.offsets[sen_idx]:corpus.offsets[sen_idx + 1]]
+        s_pos = s_pos[s_pos >= 0].tolist()
         data_pos.append(s_pos)
-        s_data_list.append(languages[language_map[sen_idx]])
-        s_data_list.append([sen_idx])
-        data_list.append(s_data_list)
+        data_list.append([s_pos, languages[language_map[sen_idx]], [sen_idx]])
         sentence_map[sen_idx] = s_pos
-        sen_idx += 1
     data_pos = np.array(data_pos)
     return data_list, data_pos, sentence_map
 
@@ -604,15 +878,10 @@ def eval_ml(predicted, gold, test_path, log_path, language_map, languages, epoch
     correct_counter = np.zeros(len(languages))
     total_counter = np.zeros(len(languages))
     for s in range(len(gold)):
-        ps = predicted[s][0]
-        gs = gold[s]
+        gold_head = gold.sentence_head(s)
         lan_id = languages[language_map[s]]
-        for i, e in enumerate(gs.entries):
-            if i == 0:
-                continue
-            if ps[i] == e.parent_id:
-                correct_counter[lan_id] += 1
-            total_counter[lan_id] += 1
+        correct_counter[lan_id] += np.sum(np.asarray(predicted[s][0])[1:len(gold_head)] == gold_head[1:])
+        total_counter[lan_id] += len(gold_head) - 1
     accuracy = old_div(correct_counter, total_counter)
     for l in list(languages.keys()):
         print('UAS is ' + str(accuracy[languages[l]] * 100) + '% for ' + l)